@@ -1,15 +1,41 @@
 """User blue print definitions."""
 
+import logging
 import pendulum
 import json
+import threading
 
+from concurrent.futures import ThreadPoolExecutor
 from flask import Blueprint
 from flask import request
 from flask import Response
+from flask import stream_with_context
+from mongoengine.queryset.visitor import Q
 from model.models import User, Alert, AlertRecord
+from pymongo.errors import BulkWriteError
+from shared.instances import broker
+from shared.utils import get_id_arg, get_int_arg
 
 alerts_blueprint = Blueprint('alerts_blueprint', __name__)
 
+MAX_ALERT_RECORDS = 100
+
+COALESCE_WINDOW = 10 * 60  # seconds
+
+# events of these types are coalesced into a record for a post or a comment.
+COALESCED_MESSAGES = {
+    "FAVORITE": "{nick_name} 님 외 {others}명이 당신의 게시물을 좋아합니다.",
+    "THUMB_UP": "{nick_name} 님 외 {others}명이 당신의 댓글을 좋아합니다."
+}
+
+STREAM_HEARTBEAT = 15  # seconds
+
+retention_executor = ThreadPoolExecutor(max_workers=1)
+
+
+def get_alert_channel(user_id) -> str:
+    return "alerts:{user_id}".format(user_id=user_id)
+
 
 def create_alert(user_from=None, user_to=None, push_type=None,
                  chat_room=None, post=None, comment=None,
@@ -20,12 +46,27 @@ def create_alert(user_from=None, user_to=None, push_type=None,
         raise Exception(
             "user_from or user_to is a required value.")
     
-    alert = Alert.objects(owner=user_to).first()
-    
-    if not alert:
-        alert = Alert(owner=user_to).save()
+    if push_type in COALESCED_MESSAGES:
+        records = AlertRecord.objects(
+            owner=user_to, push_type=push_type,
+            created_at__gte=current_time_stamp - COALESCE_WINDOW)
+        records = records.filter(post_id=post.id) if post \
+            else records.filter(post_id__exists=False)
+        records = records.filter(comment_id=comment.id) if comment \
+            else records.filter(comment_id__exists=False)
+        # the record moves to the top of the alerts as a new one.
+        push = records.modify(
+            new=True, inc__count=1,
+            set__user_id=user_from.id,
+            set__message=message,
+            set__is_read=False,
+            set__created_at=current_time_stamp)
+        if push:
+            publish_alert(push, user_from, user_to)
+            return push
     
     push = AlertRecord(
+        owner=user_to,
         push_type=push_type,
         user_id=user_from.id,
         
@@ -36,52 +77,179 @@ def create_alert(user_from=None, user_to=None, push_type=None,
         
         message=message,
         created_at=current_time_stamp
-    )
+    ).save()
+    
+    retention_executor.submit(enforce_alert_retention, user_to.id)
+    publish_alert(push, user_from, user_to)
+    
+    return push
+
+
+def publish_alert(push: AlertRecord, user_from, user_to):
+    """Wakes the alert streams of the owner."""
+    channel = get_alert_channel(user_to.id)
+    if broker.has_subscribers(channel):
+        broker.publish(channel, dictify_push_item(push, user_from))
+
+
+def enforce_alert_retention(owner_id, keep=MAX_ALERT_RECORDS):
+    """Removes the records older than the latest `keep` ones."""
+    try:
+        stale_ids = AlertRecord.objects(owner=owner_id).order_by(
+            "-created_at").skip(keep).scalar("id")
+        stale_ids = list(stale_ids)
+        if stale_ids:
+            AlertRecord.objects(id__in=stale_ids).delete()
+    except Exception as e:
+        logging.exception(e)
+
+
+def migrate_legacy_alerts():
+    """Moves records embedded in Alert documents to AlertRecord."""
+    collection = AlertRecord._get_collection()
     
-    alert.records = alert.records[:99]
-    alert.records.append(push)
-    alert.save()
+    for alert in Alert.objects.as_pymongo().no_cache():
+        records = []
+        for record in alert.get("records", []):
+            record = dict(record, owner=alert.get("owner"))
+            record["_id"] = record.pop("id")
+            record["is_read"] = bool(record.get("is_read"))
+            records.append(record)
+        
+        if records:
+            try:
+                collection.insert_many(records, ordered=False)
+            except BulkWriteError as e:
+                # records inserted by a previous run are skipped.
+                logging.warning(e.details.get("writeErrors"))
+        
+        Alert.objects(id=alert["_id"]).delete()
+        enforce_alert_retention(alert.get("owner"))
+
+
+def start_legacy_alerts_migration() -> threading.Thread:
+    """Migrates the legacy alerts in the background. A run in every
+       process is safe, the records moved by another are skipped.
+    """
+    def migrate():
+        try:
+            migrate_legacy_alerts()
+        except Exception as e:
+            logging.exception(e)
     
-    return alert
+    worker = threading.Thread(
+        target=migrate, name="migrate-legacy-alerts", daemon=True)
+    worker.start()
+    return worker
 
 
 @alerts_blueprint.route('/alerts', methods=['GET'])
 def list_alerts():
     uid = request.headers.get("uid")
     
+    before = get_id_arg("before")
+    limit = get_int_arg("limit", MAX_ALERT_RECORDS)
+    limit = max(1, min(limit, MAX_ALERT_RECORDS))
+    
     user = User.objects.get_or_404(uid=uid)
     
-    alert = Alert.objects(owner=user).first()
-    if not alert:
-        alert = Alert(owner=user, records=[]).save()
+    records = AlertRecord.objects(owner=user)
     
-    records = alert.records
+    if before:  # records older than the given push_id
+        cursor = AlertRecord.objects.only("created_at").get_or_404(
+            id=before, owner=user)
+        records = records.filter(
+            Q(created_at__lt=cursor.created_at) |
+            Q(created_at=cursor.created_at, id__lt=cursor.id))
     
-    result = []
-    for push in records:
-        push_dict: dict = dictify_push_item(push)
-        result.append(push_dict)
+    records = records.order_by(
+        "-created_at", "-id").limit(limit)
+    
+    result = dictify_push_items(list(records))
     
     return Response(
         json.dumps(result), mimetype='application/json')
 
 
+@alerts_blueprint.route('/alerts/stream', methods=['GET'])
+def stream_alerts():
+    """Server-Sent Events of the alerts created after `since`."""
+    uid = request.headers.get("uid")
+    since = get_int_arg("since", pendulum.now().int_timestamp)
+    
+    user = User.objects.only("id").get_or_404(uid=uid)
+    
+    def to_event(push_dict: dict) -> str:
+        return "id: {id}\nevent: alert\ndata: {data}\n\n".format(
+            id=push_dict["push_id"], data=json.dumps(push_dict))
+    
+    def generate():
+        # subscribes first not to miss the alerts created while reading.
+        with broker.subscribe(get_alert_channel(user.id)) as subscription:
+            records = AlertRecord.objects(
+                owner=user, created_at__gt=since).order_by(
+                "created_at", "id").limit(MAX_ALERT_RECORDS)
+            for push_dict in dictify_push_items(list(records)):
+                yield to_event(push_dict)
+            
+            while True:
+                push_dict = subscription.get(timeout=STREAM_HEARTBEAT)
+                if push_dict is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield to_event(push_dict)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache',
+                 'X-Accel-Buffering': 'no'})
+
+
+@alerts_blueprint.route('/alerts/unread_count', methods=['GET'])
+def get_unread_alerts_count():
+    uid = request.headers.get("uid")
+    
+    user = User.objects.only("id").get_or_404(uid=uid)
+    
+    count = AlertRecord.objects(owner=user, is_read=False).count()
+    
+    return Response(
+        json.dumps(dict(unread_count=count)),
+        mimetype='application/json')
+
+
 @alerts_blueprint.route('/alerts', methods=['PUT'])
 def update_all_alerts_as_read():
     uid = request.headers.get("uid")
     
-    user = User.objects.get_or_404(uid=uid)
+    until = get_int_arg("until")
+    
+    user = User.objects.only("id").get_or_404(uid=uid)
     
-    alert = Alert.objects.get_or_404(owner=user)
-    records = alert.records
+    records = AlertRecord.objects(owner=user, is_read=False)
     
-    for push in records:
-        push.is_read = True
+    if until:  # keeps the records newer than the client has seen unread.
+        records = records.filter(created_at__lte=until)
     
-    alert.save()
+    records.update(set__is_read=True)
     return Response("", mimetype='application/json')
 
 
+def dictify_push_items(items: list) -> list:
+    """Dictifies records with their senders loaded by a single query."""
+    user_ids = list({item.user_id for item in items if item.user_id})
+    users = User.objects(id__in=user_ids).only(
+        "nick_name", "user_images") if user_ids else []
+    users_by_id = {user.id: user for user in users}
+    
+    # records whose sender has been deleted are not shown.
+    return [
+        dictify_push_item(item, users_by_id[item.user_id])
+        for item in items if item.user_id in users_by_id
+    ]
+
+
 def dictify_push_item(item: AlertRecord, user=None) -> dict:
     user = user or User.objects.get_or_404(id=item.user_id)
     
@@ -90,7 +258,6 @@ def dictify_push_item(item: AlertRecord, user=None) -> dict:
     user_image = next(iter(user.user_images or []), None)
     image_url = user_image.url if user_image else ""
     
-    push_id = item.id
     user_id = item.user_id
     post_id = item.post_id or ""
     comment_id = item.comment_id or ""
@@ -99,11 +266,14 @@ def dictify_push_item(item: AlertRecord, user=None) -> dict:
     chat_room_id = item.chat_room_id or ""
     
     message = item.message
+    count = item.count or 1
+    if count > 1 and push_type in COALESCED_MESSAGES:
+        message = COALESCED_MESSAGES[push_type].format(
+            nick_name=nick_name, others=count - 1)
     created_at = str(item.created_at)
     is_read = str(item.is_read)
     
-    return dict(
-        push_id=str(push_id),
+    result = dict(
         user_id=str(user_id),
         post_id=str(post_id),
         comment_id=str(comment_id),
@@ -115,6 +285,11 @@ def dictify_push_item(item: AlertRecord, user=None) -> dict:
         nick_name=nick_name,
         image_url=image_url,
         message=message,
+        count=str(count),
         created_at=created_at,
         is_read=is_read
     )
+    # chat pushes are built from records never stored.
+    if item.id:
+        result["push_id"] = str(item.id)
+    return result
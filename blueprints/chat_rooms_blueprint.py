@@ -2,18 +2,32 @@ import json
 import logging
 import pendulum
 
+from bson.objectid import ObjectId
 from blueprints import alerts_blueprint
+from flask import abort
 from flask import Blueprint
 from flask import Response
 from flask import request
-from firebase_admin import messaging
-from model.models import User, ChatRoom, Message, AlertRecord
+from flask import stream_with_context
+from mongoengine.queryset.visitor import Q
+from model.models import User, ChatRoom, ChatMessage, MessagePreview, AlertRecord
+from pymongo.errors import BulkWriteError
+from shared import chat_archive
 from shared import message_service
+from shared import push_outbox
+from shared.instances import broker
+from shared.utils import get_id_arg, get_int_arg, get_registration_tokens
 
 from firebase_admin import auth
 
 chat_rooms_blueprint = Blueprint('chat_rooms_blueprint', __name__)
 
+RECENT_MESSAGES = 30  # messages shipped with a chat room
+MAX_MESSAGES = 100  # messages in a page
+PREVIEW_LENGTH = 100  # characters of the last message kept in the room
+MIGRATION_BATCH_SIZE = 1000
+DUPLICATE_KEY_ERROR = 11000
+
 
 @chat_rooms_blueprint.route(
     '/chat_rooms', methods=['POST'])
@@ -62,14 +76,234 @@ def route_list_user_chat_rooms():
         mimetype="application/json")
 
 
+@chat_rooms_blueprint.route(
+    '/chat_rooms/inbox', methods=['GET'])
+def route_list_inbox():
+    """Rooms of the user with member cards, the last message
+       and the unread count, latest first.
+    """
+    uid = request.headers.get("uid", None)
+    user = User.objects.only("id").get_or_404(uid=uid)
+    
+    chat_rooms = list(ChatRoom.objects.aggregate(
+        {"$match": {"members": user.id}},
+        {"$sort": {"last_message.created_at": -1, "created_at": -1}},
+        {"$lookup": {
+            "from": User._get_collection_name(),
+            "localField": "members",
+            "foreignField": "_id",
+            "as": "members"
+        }},
+        {"$project": {
+            "title": 1,
+            "available": 1,
+            "available_at": 1,
+            "created_at": 1,
+            "last_message": 1,
+            "last_read_message_ids.%s" % user.id: 1,
+            "members._id": 1,
+            "members.nick_name": 1,
+            "members.user_images.url": 1
+        }}))
+    
+    unread_counts = get_unread_counts(user.id, chat_rooms)
+    
+    inbox = []
+    for chat_room in chat_rooms:
+        last_message = chat_room.get("last_message")
+        inbox.append(dict(
+            id=str(chat_room["_id"]),
+            title=chat_room.get("title"),
+            available=chat_room.get("available"),
+            available_at=chat_room.get("available_at"),
+            created_at=chat_room.get("created_at"),
+            members=[dictify_member_card(member)
+                     for member in chat_room["members"]],
+            last_message=dict(
+                id=str(last_message["id"]),
+                user_id=str(last_message.get("user_id")),
+                message=last_message.get("message"),
+                created_at=last_message.get("created_at")
+            ) if last_message else None,
+            unread_count=unread_counts.get(chat_room["_id"], 0)))
+    
+    return Response(
+        json.dumps(inbox),
+        mimetype="application/json")
+
+
+@chat_rooms_blueprint.route(
+    '/chat_rooms/stream', methods=['GET'])
+def route_stream_messages():
+    """Server-Sent Events of the messages posted to the rooms of the user
+       after `since`.
+    """
+    uid = request.headers.get("uid", None)
+    since = get_int_arg("since", pendulum.now().int_timestamp)
+    
+    user = User.objects.only("id").get_or_404(uid=uid)
+    
+    def to_event(frame: dict) -> str:
+        return "id: {id}\nevent: message\ndata: {data}\n\n".format(
+            id=frame["id"], data=json.dumps(frame))
+    
+    def generate():
+        # subscribes first not to miss the messages posted while reading.
+        with broker.subscribe(get_chat_channel(user.id)) as subscription:
+            room_ids = ChatRoom.objects(members=user).scalar("id")
+            messages = ChatMessage.objects(
+                chat_room__in=list(room_ids), created_at__gt=since).order_by(
+                "created_at", "id").limit(MAX_MESSAGES).no_dereference()
+            for message in messages:
+                yield to_event(dict(
+                    dictify_message(message),
+                    chat_room_id=str(message.chat_room.id)))
+            
+            while True:
+                frame = subscription.get(
+                    timeout=alerts_blueprint.STREAM_HEARTBEAT)
+                if frame is None:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield to_event(frame)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache",
+                 "X-Accel-Buffering": "no"})
+
+
 @chat_rooms_blueprint.route(
     '/chat_rooms/<room_id>', methods=['GET'])
 def route_get_chat_room(room_id):
     uid = request.headers.get("uid", None)
     user = User.objects.get_or_404(uid=uid)
     chat_room = ChatRoom.objects.get_or_404(id=room_id, members=user)
-    return Response(chat_room.to_json(
-        follow_reference=True, max_depth=1),
+    
+    # only the latest messages, the room costs the same however long it is.
+    messages = ChatMessage.objects(chat_room=chat_room).order_by(
+        "-created_at", "-id").limit(RECENT_MESSAGES)
+    
+    chat_room = json.loads(chat_room.to_json(
+        follow_reference=True, max_depth=1))
+    chat_room["messages"] = [
+        dictify_message(message) for message in reversed(list(messages))
+    ]
+    return Response(
+        json.dumps(chat_room),
+        mimetype="application/json")
+
+
+@chat_rooms_blueprint.route(
+    '/chat_rooms/<room_id>/messages', methods=['GET'])
+def route_list_messages(room_id: str):
+    """Messages newest first, older than `before` or newer than `after`.
+       The pages past the messages in the collection are read from the archive.
+    """
+    uid = request.headers.get("uid", None)
+    
+    before = get_id_arg("before")
+    after = get_id_arg("after")
+    limit = get_int_arg("limit", RECENT_MESSAGES)
+    limit = max(1, min(limit, MAX_MESSAGES))
+    
+    user = User.objects.only("id").get_or_404(uid=uid)
+    chat_room = ChatRoom.objects.only("id", "archived_until").get_or_404(
+        id=room_id, members=user)
+    
+    messages = ChatMessage.objects(chat_room=chat_room).only(
+        "user_id", "message", "created_at")
+    
+    # a cursor not found in the collection has been archived,
+    # the messages in the collection are newer than the archived ones.
+    archived_before = archived_after = None
+    
+    if before:  # messages older than the given message_id
+        cursor = ChatMessage.objects(id=before, chat_room=chat_room).only(
+            "created_at").first()
+        if cursor:
+            messages = messages.filter(
+                Q(created_at__lt=cursor.created_at) |
+                Q(created_at=cursor.created_at, id__lt=cursor.id))
+        else:
+            archived_before = before
+            messages = messages.none()
+    
+    if after:  # messages newer than the given message_id
+        cursor = ChatMessage.objects(id=after, chat_room=chat_room).only(
+            "created_at").first()
+        if cursor:
+            messages = messages.filter(
+                Q(created_at__gt=cursor.created_at) |
+                Q(created_at=cursor.created_at, id__gt=cursor.id))
+        else:
+            archived_after = after
+    
+    if after and not before:
+        # the messages right after the cursor, not the latest ones.
+        archived = []
+        if archived_after and chat_room.archived_until:
+            archived = chat_archive.list_archived_messages(
+                chat_room.id, after=archived_after, limit=limit,
+                newest=False)
+        newer = []
+        if len(archived) < limit:
+            newer = [
+                dictify_message(message) for message in messages.order_by(
+                    "created_at", "id").limit(limit - len(archived))
+            ]
+        messages = newer[::-1] + archived
+    else:
+        messages = [
+            dictify_message(message) for message in messages.order_by(
+                "-created_at", "-id").limit(limit)
+        ]
+        if len(messages) < limit and chat_room.archived_until and \
+                (not after or archived_after):
+            # the history goes on in the archive.
+            messages += chat_archive.list_archived_messages(
+                chat_room.id, before=archived_before, after=archived_after,
+                limit=limit - len(messages))
+    
+    return Response(
+        json.dumps(messages),
+        mimetype="application/json")
+
+
+@chat_rooms_blueprint.route(
+    '/chat_rooms/<room_id>/read', methods=['GET'])
+def route_get_read_state(room_id: str):
+    """The last read message of each member and the unread count."""
+    uid = request.headers.get("uid", None)
+    user = User.objects.only("id").get_or_404(uid=uid)
+    chat_room = ChatRoom.objects.only(
+        "last_message", "last_read_message_ids").get_or_404(
+        id=room_id, members=user)
+    
+    return Response(
+        json.dumps(dictify_read_state(user, chat_room)),
+        mimetype="application/json")
+
+
+@chat_rooms_blueprint.route(
+    '/chat_rooms/<room_id>/read/<message_id>', methods=['PUT'])
+def route_update_last_read_message(room_id: str, message_id: str):
+    uid = request.headers.get("uid", None)
+    user = User.objects.only("id").get_or_404(uid=uid)
+    message = ChatMessage.objects.only("id").get_or_404(
+        id=message_id, chat_room=room_id)
+    
+    # $max never moves the pointer back when reads arrive out of order.
+    chat_room = ChatRoom.objects(id=room_id, members=user).only(
+        "last_message", "last_read_message_ids").modify(
+        new=True, **{
+            "max__last_read_message_ids__%s" % user.id: message.id})
+    if not chat_room:
+        abort(404)
+    
+    return Response(
+        json.dumps(dictify_read_state(user, chat_room)),
         mimetype="application/json")
 
 
@@ -79,34 +313,119 @@ def route_create_message(room_id: str, message: str):
     uid = request.headers.get("uid", None)
     
     user = User.objects.get_or_404(uid=uid)
+    if not ObjectId.is_valid(room_id):
+        abort(404)
+    
+    # the membership is checked by the write moving the sender's read
+    # pointer, not by a read a removal could land after.
+    message_id = ObjectId()
+    chat_room = ChatRoom.objects(id=room_id, members=user).only(
+        "members").modify(new=True, **{
+            "max__last_read_message_ids__%s" % user.id: message_id})
+    if not chat_room:
+        abort(404)
     
-    message = Message(
-        user_id=str(user.id),
+    message = ChatMessage(
+        id=message_id,
+        chat_room=chat_room,
+        user_id=user.id,
         message=message,
         created_at=pendulum.now().int_timestamp)
     
-    chat_room = ChatRoom.objects.get_or_404(id=room_id, members=user)
-    chat_room.messages.append(message)
-    chat_room.save()
+    # save() would ensure the indexes on every message, a createIndexes
+    # round trip each, racing the other posts on mongomock.
+    ChatMessage.objects.insert(message, load_bulk=False)
+    
+    set_last_message(chat_room.id, preview_message(message))
+    
+    deliver_messages(chat_room, user, [message])
+    
+    return Response(
+        json.dumps(dictify_message(message)),
+        mimetype="application/json")
+
+
+@chat_rooms_blueprint.route(
+    '/chat_rooms/<room_id>/messages', methods=['POST'])
+def route_create_messages(room_id: str):
+    """Stores the messages queued by an offline client at once.
+       A message sent again with the same client_id is stored once.
+    """
+    uid = request.headers.get("uid", None)
+    body = request.get_json(silent=True)
+    items = body.get("messages") if isinstance(body, dict) else None
+    # 1 to MAX_MESSAGES messages, each with a client_id.
+    if not isinstance(items, list) or not 0 < len(items) <= MAX_MESSAGES:
+        abort(400)
+    if not all(isinstance(item, dict) and
+               isinstance(item.get("client_id"), str) and
+               item["client_id"] and item.get("message")
+               for item in items):
+        abort(400)
+    
+    user = User.objects.get_or_404(uid=uid)
+    chat_room = ChatRoom.objects.only("members").get_or_404(
+        id=room_id, members=user)
+    
+    created_at = pendulum.now().int_timestamp
+    messages = []
+    for item in items:
+        messages.append(ChatMessage(
+            id=ObjectId(),
+            chat_room=chat_room,
+            user_id=user.id,
+            message=str(item["message"]),
+            client_id=get_client_id(chat_room, user, item["client_id"]),
+            created_at=created_at))
+    
+    try:
+        ChatMessage._get_collection().insert_many(
+            [message.to_mongo() for message in messages], ordered=False)
+        duplicated = set()
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error["code"] != DUPLICATE_KEY_ERROR for error in errors):
+            raise
+        duplicated = {error["index"] for error in errors}
     
-    user_from = user
-    user_to_list = [
-        member for member in chat_room.members if member.id != user.id
+    created = [
+        message for index, message in enumerate(messages)
+        if index not in duplicated
     ]
+    if created:
+        update_last_message(chat_room, user, created[-1])
+        deliver_messages(chat_room, user, created)
     
-    for user_to in user_to_list:
-        push = AlertRecord(
-            push_type="MESSAGE",
-            user_id=user_from.id,
-            created_at=pendulum.now().int_timestamp,
-            chat_room_id=chat_room.id,
-            message_id=message.id,
-            message=message.message
-        )
-        data = alerts_blueprint.dictify_push_item(push)
-        message_service.push(data, user_to.r_token)
+    if duplicated:
+        # the messages stored by the previous attempts are returned as is.
+        stored = ChatMessage.objects(
+            chat_room=chat_room, user_id=user.id,
+            client_id__in=[message.client_id for message in messages])
+        stored = {
+            message.client_id: dictify_message(message) for message in stored
+        }
+        # archived since the insert found them, rare enough to read there.
+        # a segment written before the client ids were kept has none.
+        archived = [
+            message.client_id for message in messages
+            if message.client_id not in stored
+        ]
+        if archived:
+            stored.update(chat_archive.find_archived_messages(
+                chat_room.id, archived))
+        results = [
+            stored.get(message.client_id) or dictify_message(message)
+            for message in messages
+        ]
+    else:
+        results = [dictify_message(message) for message in messages]
     
-    return Response(message.to_json(), mimetype="application/json")
+    return Response(
+        json.dumps([
+            dict(result, client_id=item["client_id"])
+            for result, item in zip(results, items)
+        ]),
+        mimetype="application/json")
 
 
 @chat_rooms_blueprint.route(
@@ -130,59 +449,214 @@ def route_update_chat_room_available(room_id: str, available: bool):
     chat_room.available_at = pendulum.now().int_timestamp
     chat_room.save()
     
+    registration_tokens = []
     for user_to in chat_room.members:
-        if user_to.uid == room_open_user.uid:
-            continue
-        push = AlertRecord(
-            push_type="OPENED",
-            user_id=room_open_user.id,
-            created_at=pendulum.now().int_timestamp,
-            chat_room_id=chat_room.id,
-            message="{nick_name} 님이 대화방을 열었습니다.".format(
-                nick_name=room_open_user.nick_name)
-        )
-        data = alerts_blueprint.dictify_push_item(push)
-        message_service.push(data, user_to.r_token)
+        if user_to.uid != room_open_user.uid:
+            registration_tokens.extend(get_registration_tokens(user_to))
+    
+    send_message(
+        chat_room_id=chat_room.id, user=room_open_user,
+        message="{nick_name} 님이 대화방을 열었습니다.".format(
+            nick_name=room_open_user.nick_name),
+        registration_tokens=registration_tokens,
+        created_at=chat_room.available_at, push_type="OPENED")
     
     return Response(
         "", mimetype="application/json")
 
 
-def send_message(chat_room_id=None, user_id=None, message=None, message_id=None,
-                 registration_tokens=None, created_at=None, failed_count=0):
-    if not chat_room_id or not user_id or not message_id or not registration_tokens:
-        raise ValueError(
-            "Invalid arguments found: chat_room_id={chat_room_id}, user_id={user_id}, "
-            "message_id={message_id}, token={token}".format(
-                chat_room_id=chat_room_id, user_id=user_id,
-                message_id=message_id, token=registration_tokens))
-    
-    if failed_count > 3:
-        return
-    
-    message = messaging.MulticastMessage(
-        data=dict(
-            type="MESSAGE",
-            user_id=str(user_id),
-            created_at=str(created_at),
-            # the belows are for chatting only
-            chat_room_id=str(chat_room_id),
-            message_id=str(message_id),
-            message=str(message)),
-        tokens=registration_tokens,
-        # android=messaging.AndroidConfig(priority="high"),
-        apns=messaging.APNSConfig(),
-        notification=messaging.Notification()
-    )
-    
-    response = messaging.send_multicast(message)
-    # cBdvpdzJSIyOVKZPsWNOGs:APA91bGNyQMxmWWgNVr3LJzM2PPnjmWtfADVaGoG0RHCiFJHFm7bd534EeoWm0REzxwxuzD5hbFbzhsQgP4557WN3m2YYOaJC3FeXCFEsmI9z8qj0Jlzm6SAaQypzCyxO4UHme0yNf5T
-    if response.failure_count > 0:
-        responses = response.responses
-        failed_tokens = []
-        for idx, resp in enumerate(responses):
-            if not resp.success:
-                # The order of responses corresponds to the order of the registration tokens.
-                failed_tokens.append(registration_tokens[idx])
+def get_unread_counts(user_id, chat_rooms: list) -> dict:
+    """Counts the messages of others after the last read of the user
+       in every room with a single aggregation, keyed by the room id.
+    """
+    ranges = []
+    for chat_room in chat_rooms:
+        if not chat_room.get("last_message"):
+            continue
+        last_read_message_id = chat_room.get(
+            "last_read_message_ids", {}).get(str(user_id))
+        if last_read_message_id == chat_room["last_message"]["id"]:
+            continue
+        unread = {"chat_room": chat_room["_id"]}
+        if last_read_message_id:
+            unread["_id"] = {"$gt": last_read_message_id}
+        ranges.append(unread)
+    
+    if not ranges:
+        return {}
+    
+    counts = ChatMessage.objects.aggregate(
+        {"$match": {"$or": ranges, "user_id": {"$ne": user_id}}},
+        {"$group": {"_id": "$chat_room", "count": {"$sum": 1}}})
+    return {count["_id"]: count["count"] for count in counts}
+
+
+def dictify_read_state(user: User, chat_room: ChatRoom) -> dict:
+    unread_counts = get_unread_counts(user.id, [chat_room.to_mongo()])
+    return dict(
+        last_read_message_ids={
+            user_id: str(message_id) for user_id, message_id
+            in chat_room.last_read_message_ids.items()
+        },
+        unread_count=unread_counts.get(chat_room.id, 0))
+
+
+def dictify_member_card(member: dict) -> dict:
+    user_image = next(iter(member.get("user_images") or []), None)
+    return dict(
+        id=str(member["_id"]),
+        nick_name=member.get("nick_name"),
+        image_url=user_image.get("url") if user_image else None)
+
+
+def update_last_message(chat_room: ChatRoom, user: User, message: ChatMessage):
+    """Previews the stored message unless a newer one is previewed already,
+       the sender has read up to the message.
+    """
+    set_last_message(chat_room.id, preview_message(message))
+    # $max never moves the pointer back when posts land out of order.
+    ChatRoom.objects(id=chat_room.id).update_one(**{
+        "max__last_read_message_ids__%s" % user.id: message.id})
+
+
+def preview_message(message: ChatMessage) -> MessagePreview:
+    return MessagePreview(
+        id=message.id,
+        user_id=message.user_id,
+        message=message.message[:PREVIEW_LENGTH],
+        created_at=message.created_at)
+
+
+def set_last_message(chat_room_id, preview: MessagePreview):
+    """Sets the preview unless a newer message is previewed already."""
+    ChatRoom.objects(
+        Q(id=chat_room_id) & (
+            Q(last_message__created_at__exists=False) |
+            Q(last_message__created_at__lt=preview.created_at) |
+            Q(last_message__created_at=preview.created_at,
+              last_message__id__lt=preview.id))).update_one(
+        set__last_message=preview)
+
+
+def get_chat_channel(user_id) -> str:
+    return "chats:{user_id}".format(user_id=user_id)
+
+
+def get_client_id(chat_room: ChatRoom, user: User, client_id: str) -> str:
+    """Client ids are unique per room and user. The key is scoped itself
+       as a sparse compound index would take every message without one.
+    """
+    return "{0}:{1}:{2}".format(chat_room.id, user.id, client_id)
+
+
+def deliver_messages(chat_room: ChatRoom, user: User, messages: list):
+    """The members streaming the chat get the messages right away,
+       the others get a single push of the last one.
+    """
+    frames = [
+        dict(dictify_message(message), chat_room_id=str(chat_room.id))
+        for message in messages
+    ]
+    registration_tokens = []
+    for member in chat_room.members:
+        channel = get_chat_channel(member.id)
+        received = [broker.publish(channel, frame) for frame in frames]
+        if member.id != user.id and not any(received):
+            registration_tokens.extend(get_registration_tokens(member))
+    
+    last_message = messages[-1]
+    send_message(
+        chat_room_id=chat_room.id, user=user, message=last_message.message,
+        message_id=last_message.id, registration_tokens=registration_tokens,
+        created_at=last_message.created_at, count=len(messages))
+
+
+def dictify_message(message: ChatMessage) -> dict:
+    return dict(
+        id=str(message.id),
+        user_id=str(message.user_id),
+        message=message.message,
+        created_at=message.created_at)
+
+
+def migrate_chat_messages(batch_size=MIGRATION_BATCH_SIZE):
+    """Moves messages embedded in ChatRoom documents to ChatMessage,
+       a room at a time so the rooms are never loaded all together.
+    """
+    rooms = ChatRoom._get_collection()
+    collection = ChatMessage._get_collection()
+    
+    legacy_rooms = rooms.find(
+        {"messages": {"$exists": True}}, {"messages": 1},
+        batch_size=1)
+    for room in legacy_rooms:
+        messages = room.get("messages") or []
+        for index in range(0, len(messages), batch_size):
+            records = []
+            for message in messages[index:index + batch_size]:
+                record = dict(message, chat_room=room["_id"])
+                record["_id"] = record.pop("id", None) or ObjectId()
+                records.append(record)
+            try:
+                collection.insert_many(records, ordered=False)
+            except BulkWriteError as e:
+                # messages inserted by a previous run are skipped.
+                logging.warning(e.details.get("writeErrors"))
         
-        logging.error('List of tokens that caused failures: %s' % failed_tokens)
+        if messages:
+            # a message posted since the deploy is previewed already.
+            last_message = max(messages, key=lambda m: m["created_at"])
+            set_last_message(room["_id"], MessagePreview(
+                id=last_message.get("id"),
+                user_id=last_message.get("user_id"),
+                message=(last_message.get("message") or "")[:PREVIEW_LENGTH],
+                created_at=last_message["created_at"]))
+        rooms.update_one({"_id": room["_id"]}, {"$unset": {"messages": ""}})
+
+
+def send_message(chat_room_id=None, user=None, message=None, message_id=None,
+                 registration_tokens=None, created_at=None,
+                 push_type="MESSAGE", count=1):
+    """Pushes a chat event to the devices of every recipient as a single
+       multicast, the tokens failed for a while are left to the outbox.
+    """
+    if not chat_room_id or not user:
+        raise ValueError(
+            "Invalid arguments found: chat_room_id={chat_room_id}, "
+            "user={user}".format(chat_room_id=chat_room_id, user=user))
+    
+    registration_tokens = message_service.get_live_tokens(registration_tokens)
+    if not registration_tokens:
+        return None
+    
+    # a payload for every recipient, built without querying the sender.
+    push = AlertRecord(
+        push_type=push_type,
+        user_id=user.id,
+        created_at=created_at,
+        chat_room_id=chat_room_id,
+        message_id=message_id,
+        message=message,
+        count=count)
+    data = alerts_blueprint.dictify_push_item(push, user)
+    
+    # a full dispatcher fails the future, the outbox retries the tokens.
+    future = message_service.dispatch(data, registration_tokens)
+    if not future:
+        return None
+    
+    def retry(done_future):
+        try:
+            failed_tokens, exception = push_outbox.get_failed_tokens(
+                registration_tokens, done_future.result())
+        except Exception as e:
+            failed_tokens, exception = registration_tokens, e
+        if not failed_tokens:
+            return
+        try:
+            push_outbox.retry_later(data, failed_tokens, exception)
+        except Exception as e:
+            logging.exception(e)
+    
+    future.add_done_callback(retry)
+    return future
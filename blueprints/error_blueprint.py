@@ -1,12 +1,17 @@
 import logging
 
 from flask import Blueprint, jsonify
+from werkzeug.exceptions import HTTPException
 
 errors_blue_print = Blueprint('errors', __name__)
 
 
 @errors_blue_print.app_errorhandler(Exception)
 def handle_unexpected_error(error):
+    # abort() answers with its own status code.
+    if isinstance(error, HTTPException):
+        return error
+    
     logging.exception(error)
     
     status_code = 500
@@ -1,3 +1,5 @@
+import base64
+import itertools
 import json
 import uuid
 import pendulum
@@ -7,12 +9,36 @@ from flask import abort
 from flask import Blueprint
 from flask import Response
 from flask import request
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
 from firebase_admin import storage
+from mongoengine.queryset.visitor import Q
 from model.models import User, Post, Comment
 from shared import message_service
+from shared.utils import get_int_arg, get_registration_tokens
 
 posts_blueprint = Blueprint('posts_blueprint', __name__)
 
+POSTS_PER_PAGE = 30
+MAX_POSTS_PER_PAGE = 100
+BACKFILL_BATCH_SIZE = 1000
+
+POST_FIELDS = (
+    "title", "description", "url", "favorite_user_ids", "favorite_count",
+    "comment_count", "created_at", "enable_comment", "is_deleted"
+)
+COMMENT_FIELDS = (
+    "comment", "created_at", "thumb_up_user_ids", "thumb_down_user_ids"
+)
+# the profile shown with posts, without the tokens, phone and location.
+USER_FIELDS = (
+    "uid", "nick_name", "sex", "birthed_at", "height", "body_id",
+    "occupation", "education", "religion_id", "drink_id", "smoking_id",
+    "blood_id", "introduction", "joined_at", "last_login_at", "job",
+    "area", "user_images", "charm_ids", "ideal_type_ids", "interest_ids",
+    "available", "status"
+)
+
 
 @posts_blueprint.route(
     '/posts', methods=['POST'])
@@ -62,37 +88,76 @@ def route_create_post():
 @posts_blueprint.route(
     '/posts', methods=['GET'])
 def route_list_posts():
-    page: int = int(request.args.get("page", 0))
-    per_page: int = int(request.args.get("per_page", 30))
+    """Posts newest first after the `cursor` of the previous page,
+       which is given in the X-Next-Cursor header while there are more.
+       `page` is still accepted by the clients not sending the cursor.
+       favorited tells if the user favorited the post, favorite_count
+       is the number of the users who did. favorite_user_ids is deprecated,
+       kept until the clients read favorited.
+    """
+    uid = request.headers.get("uid", None)
+    cursor = request.args.get("cursor", None)
+    page: int = get_int_arg("page", 0)
+    per_page: int = get_int_arg("per_page", POSTS_PER_PAGE)
+    per_page = max(1, min(per_page, MAX_POSTS_PER_PAGE))
     
-    skip = page * per_page if page > 0 else 0
-    limit = (page + 1) * per_page
+    # the list of the users grows with the favorites, never read.
+    posts = Post.objects.exclude("favorite_users").order_by(
+        "-created_at", "-id")
     
-    posts = Post.objects.order_by(
-        "-created_at").skip(skip).limit(limit).all()
+    if cursor:  # posts older than the last post of the previous page
+        created_at, post_id = decode_cursor(cursor)
+        posts = posts.filter(
+            Q(created_at__lt=created_at) |
+            Q(created_at=created_at, id__lt=post_id))
+    elif page > 0:
+        posts = posts.skip(page * per_page)
     
-    converted = []
-    for post in posts:
-        post.favorite_users = []
-        post.comments.sort(
-            key=lambda x: x.created_at, reverse=True)
-        converted.append(json.loads(post.to_json(
-            follow_reference=True, max_depth=3
-        )))
+    posts = list(posts.limit(per_page).as_pymongo())
+    
+    user = User.objects(uid=uid).only("id").first() if uid else None
+    converted = dictify_posts(posts, favorited_by=user.id if user else None)
+    
+    headers = dict()
+    if len(posts) == per_page:
+        headers["X-Next-Cursor"] = encode_cursor(posts[-1])
     
     return Response(
         json.dumps(converted),
-        mimetype="application/json")
+        mimetype="application/json",
+        headers=headers)
+
+
+def encode_cursor(post: dict) -> str:
+    """An opaque cursor of the position right after the post."""
+    position = "{0}:{1}".format(post["created_at"], post["_id"])
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        position = base64.urlsafe_b64decode(cursor.encode()).decode()
+        created_at, post_id = position.split(":")
+        return int(created_at), ObjectId(post_id)
+    except (ValueError, InvalidId):
+        abort(400)
 
 
 @posts_blueprint.route(
     '/posts/<post_id>', methods=['GET'])
 def route_get_post(post_id):
-    post = Post.objects.get_or_404(id=post_id)
-    post.comments.sort(
-        key=lambda x: x.created_at, reverse=True)
-    return Response(post.to_json(
-        follow_reference=True, max_depth=3),
+    if not ObjectId.is_valid(post_id):
+        abort(404)
+    post = Post.objects(id=post_id).as_pymongo().first()
+    if not post:
+        abort(404)
+    uid = request.headers.get("uid", None)
+    user = User.objects(uid=uid).only("id").first() if uid else None
+    result = dictify_posts(
+        [post], favorite_users=True,
+        favorited_by=user.id if user else None)[0]
+    return Response(
+        json.dumps(result),
         mimetype="application/json")
 
 
@@ -115,20 +180,28 @@ def route_create_favorite(post_id: str):
     
     user = User.objects.get_or_404(uid=uid)
     post = Post.objects.get_or_404(id=post_id)
-    post.update(add_to_set__favorite_users=user,
-                add_to_set__favorite_user_ids=user.id)
-    
-    user_from = user
-    user_to = post.author
-    
-    alert = alerts_blueprint.create_alert(
-        user_from=user_from, user_to=user_to,
-        push_type="FAVORITE", post=post,
-        message="{nick_name} 님이 당신의 게시물을 좋아합니다.".format(
-            nick_name=user_from.nick_name))
-    push_item = alert.records[-1]
-    data = alerts_blueprint.dictify_push_item(push_item)
-    message_service.push(data, user_to.r_token)
+    # counted only when the user is added to the set.
+    favorited = Post.objects(
+        id=post.id, favorite_user_ids__ne=user.id).update_one(
+        add_to_set__favorite_users=user,
+        add_to_set__favorite_user_ids=user.id,
+        inc__favorite_count=1)
+    
+    # a repeated favorite is neither alerted nor pushed again.
+    if favorited:
+        user_from = user
+        user_to = post.author
+        
+        push_item = alerts_blueprint.create_alert(
+            user_from=user_from, user_to=user_to,
+            push_type="FAVORITE", post=post,
+            message="{nick_name} 님이 당신의 게시물을 좋아합니다.".format(
+                nick_name=user_from.nick_name))
+        
+        # the events coalesced into the record have been already pushed.
+        if push_item.count == 1:
+            data = alerts_blueprint.dictify_push_item(push_item, user_from)
+            message_service.push(data, get_registration_tokens(user_to))
     
     return Response(post.to_json(
         follow_reference=True, max_depth=1),
@@ -145,8 +218,11 @@ def route_delete_favorite(post_id):
     user = User.objects.get_or_404(uid=uid)
     post = Post.objects.get_or_404(id=post_id)
     
-    post.update(pull__favorite_users=user,
-                pull__favorite_user_ids=user.id)
+    # counted only when the user is removed from the set.
+    Post.objects(id=post.id, favorite_user_ids=user.id).update_one(
+        pull__favorite_users=user,
+        pull__favorite_user_ids=user.id,
+        dec__favorite_count=1)
     
     return Response(post.to_json(
         follow_reference=True, max_depth=1),
@@ -184,9 +260,11 @@ def route_create_comment(post_id: str):
             id=comment_id)
         comment_to_update.update(
             push__sub_comments=comment_to_create)
+        post.update(inc__comment_count=1)
     else:
         post.update(
-            push__comments=comment_to_create)
+            push__comments=comment_to_create,
+            inc__comment_count=1)
     
     return Response(comment_to_create.to_json(
         follow_reference=True, max_depth=1),
@@ -218,15 +296,16 @@ def route_create_thumb_up(post_id, comment_id):
         user_from = user
         user_to = comment.user
         
-        alert = alerts_blueprint.create_alert(
+        push_item = alerts_blueprint.create_alert(
             user_from=user_from, user_to=user_to,
             push_type="THUMB_UP",
             post=post, comment=comment,
             message="{nick_name} 님이 당신의 댓글을 좋아합니다.".format(
                 nick_name=user_from.nick_name))
-        push_item = alert.records[-1]
-        data = alerts_blueprint.dictify_push_item(push_item)
-        message_service.push(data, user_to.r_token)
+        
+        if push_item.count == 1:
+            data = alerts_blueprint.dictify_push_item(push_item, user_from)
+            message_service.push(data, get_registration_tokens(user_to))
     
     return Response(comment.to_json(
         follow_reference=True, max_depth=2),
@@ -319,3 +398,151 @@ def route_list_all_favorite_users(post_id):
     return Response(
         json.dumps(converted),
         mimetype="application/json")
+
+
+def dictify_posts(posts: list, favorite_users=False, favorited_by=None) -> list:
+    """Posts read by as_pymongo() with the author, the comments and their
+       users in place, in the shape of post.to_json(max_depth=3).
+       The references of the whole page are loaded by a query per level,
+       the comments, the sub comments then the users.
+       favorite_users are in place only if asked, empty otherwise.
+       favorited tells if the user id `favorited_by` favorited the post.
+    """
+    comments = load_documents(Comment, [
+        comment_id for post in posts
+        for comment_id in post.get("comments", [])
+    ])
+    comments.update(load_documents(Comment, [
+        comment_id for comment in list(comments.values())
+        for comment_id in comment.get("sub_comments", [])
+        if comment_id not in comments
+    ]))
+    users = load_documents(User, [
+        post["author"] for post in posts
+    ] + [
+        comment["user"] for comment in comments.values()
+    ] + [
+        user_id for post in posts if favorite_users
+        for user_id in post.get("favorite_users", [])
+    ], USER_FIELDS)
+    
+    def dictify_user(user_id):
+        user = users.get(user_id)
+        return dictify_document(User, user, USER_FIELDS) if user \
+            else str(user_id)
+    
+    def dictify_comment(comment: dict, depth: int) -> dict:
+        result = dictify_document(Comment, comment, COMMENT_FIELDS)
+        result["user"] = dictify_user(comment["user"])
+        if depth > 0:
+            sub_comments = [comments.get(comment_id) for comment_id
+                            in comment.get("sub_comments", [])]
+            result["sub_comments"] = [
+                dictify_comment(sub_comment, depth - 1)
+                for sub_comment in sub_comments if sub_comment
+            ]
+        else:
+            result["sub_comments"] = [
+                str(comment_id) for comment_id
+                in comment.get("sub_comments", [])
+            ]
+        return result
+    
+    converted = []
+    for post in posts:
+        result = dictify_document(Post, post, POST_FIELDS)
+        result["author"] = dictify_user(post["author"])
+        result["favorite_users"] = [
+            dictify_user(user_id) for user_id in post.get("favorite_users", [])
+        ] if favorite_users else []
+        result["favorited"] = favorited_by is not None and \
+            favorited_by in post.get("favorite_user_ids", [])
+        
+        post_comments = [comments.get(comment_id)
+                         for comment_id in post.get("comments", [])]
+        post_comments = sorted(
+            (comment for comment in post_comments if comment),
+            key=lambda comment: comment["created_at"], reverse=True)
+        result["comments"] = [
+            dictify_comment(comment, depth=1) for comment in post_comments
+        ]
+        converted.append(result)
+    
+    return converted
+
+
+def load_documents(model, ids: list, fields=()) -> dict:
+    """Raw documents of the ids by a single $in query, keyed by the id."""
+    ids = list(set(ids))
+    if not ids:
+        return {}
+    documents = model.objects(id__in=ids)
+    if fields:
+        documents = documents.only(*fields)
+    return {document["_id"]: document for document in documents.as_pymongo()}
+
+
+def dictify_document(model, document: dict, fields: tuple) -> dict:
+    """The given fields of a raw document, the missing ones defaulted
+       as the model does.
+    """
+    result = dict(id=str(document["_id"]))
+    for name in fields:
+        value = document.get(name)
+        if value is None:
+            value = model._fields[name].default
+            value = value() if callable(value) else value
+        if value is not None:
+            result[name] = encode_value(value)
+    return result
+
+
+def encode_value(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, list):
+        return [encode_value(item) for item in value]
+    if isinstance(value, dict):
+        return {key: encode_value(item) for key, item in value.items()}
+    return value
+
+
+def backfill_post_counters(batch_size=BACKFILL_BATCH_SIZE):
+    """Counts favorite_count and comment_count of the posts from their
+       lists, a batch of posts at a time. A post changed while counted is
+       left to the next run, the counters are kept by the routes after.
+    """
+    posts = Post._get_collection()
+    comments = Comment._get_collection()
+    
+    cursor = posts.find(
+        {}, {"favorite_user_ids": 1, "comments": 1}, batch_size=batch_size)
+    while True:
+        batch = list(itertools.islice(cursor, batch_size))
+        if not batch:
+            return
+        
+        sub_comment_counts = {
+            comment["_id"]: len(comment.get("sub_comments") or [])
+            for comment in comments.find(
+                {"_id": {"$in": [comment_id for post in batch
+                                 for comment_id in post.get("comments") or []]}},
+                {"sub_comments": 1})
+        }
+        
+        for post in batch:
+            favorite_user_ids = post.get("favorite_user_ids") or []
+            comment_ids = post.get("comments") or []
+            
+            # not matched if favorited or commented meanwhile.
+            condition = {"_id": post["_id"]}
+            for name in ("favorite_user_ids", "comments"):
+                if name in post:
+                    condition[name] = {"$size": len(post[name])}
+            
+            posts.update_one(condition, {"$set": {
+                "favorite_count": len(favorite_user_ids),
+                "comment_count": len(comment_ids) + sum(
+                    sub_comment_counts.get(comment_id, 0)
+                    for comment_id in comment_ids)
+            }})
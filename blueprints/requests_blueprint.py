@@ -12,6 +12,7 @@ from flask import request
 from firebase_admin import auth
 from model.models import Request, User, ChatRoom
 from shared import message_service
+from shared.utils import get_registration_tokens
 
 requests_blueprint = Blueprint("requests_blueprint", __name__)
 
@@ -91,14 +92,13 @@ def route_create_request(user_id: str, r_type: int):
         response=None, responded_at=None)
     _request.save()
     
-    alert = alerts_blueprint.create_alert(
+    push_item = alerts_blueprint.create_alert(
         user_from=user_from, user_to=user_to,
         push_type="REQUEST", _request=_request,
         message="{nick_name} 님이 당신에게 친구 신청을 보냈습니다.".format(
             nick_name=user_from.nick_name))
-    push_item = alert.records[-1]
-    data = alerts_blueprint.dictify_push_item(push_item)
-    message_service.push(data, user_to.r_token)
+    data = alerts_blueprint.dictify_push_item(push_item, user_from)
+    message_service.push(data, get_registration_tokens(user_to))
     
     return Response(
         _request.to_json(follow_reference=True, max_depth=1),
@@ -139,14 +139,13 @@ def route_update_response_of_request(rid: str, result: int):
         user_from = _request.user_to
         user_to = _request.user_from
         
-        alert = alerts_blueprint.create_alert(
+        push_item = alerts_blueprint.create_alert(
             user_from=user_from, user_to=user_to,
             push_type="MATCHED", _request=_request, chat_room=chat_room,
             message="{nick_name} 님과 연결 되었습니다.".format(
                 nick_name=_request.user_to.nick_name))
-        push_item = alert.records[-1]
-        data = alerts_blueprint.dictify_push_item(push_item)
-        message_service.push(data, user_to.r_token)
+        data = alerts_blueprint.dictify_push_item(push_item, user_from)
+        message_service.push(data, get_registration_tokens(user_to))
     
     return Response(
         _request.to_json(follow_reference=True, max_depth=1),
@@ -0,0 +1,165 @@
+"""Queries and CPU time per page of the posts feed, rendered by
+   post.to_json(max_depth=3) as it used to be and by dictify_posts.
+   mongomock counts the find calls, pass --mongo-host of a real mongod
+   for the commands sent to a server.
+    
+    python -m blueprints.test.bench_posts --posts 300 --comments 5 --sub-comments 2
+    python -m blueprints.test.bench_posts --mongo-host mongodb://127.0.0.1:27017
+"""
+
+import argparse
+import json
+import random
+import time
+
+import mongomock
+
+from mongoengine import connect
+from mongoengine.queryset.visitor import Q
+from pymongo import monitoring
+
+from blueprints import posts_blueprint
+from model.models import User, Post, Comment
+
+QUERY_COMMANDS = ("find", "aggregate", "getMore")
+
+
+class QueryCounter(monitoring.CommandListener):
+    """Counts the queries sent, mongomock's finds as it sends no events."""
+    
+    def __init__(self):
+        self.count = 0
+    
+    def started(self, event):
+        if event.command_name in QUERY_COMMANDS:
+            self.count += 1
+    
+    def succeeded(self, event):
+        pass
+    
+    def failed(self, event):
+        pass
+    
+    def patch_mongomock(self):
+        find = mongomock.collection.Collection.find
+        counter = self
+        
+        def counted_find(collection, *args, **kwargs):
+            counter.count += 1
+            return find(collection, *args, **kwargs)
+        
+        mongomock.collection.Collection.find = counted_find
+
+
+def seed(posts: int, comments: int, sub_comments: int, users: int):
+    authors = User.objects.insert([
+        User(uid="bench-{0}".format(index),
+             nick_name="bench_{0}".format(index),
+             r_tokens=["bench-token-{0}".format(index)],
+             joined_at=index)
+        for index in range(users)
+    ])
+    
+    def comment(created_at, children=()):
+        return Comment(user=random.choice(authors), comment="bench",
+                       sub_comments=list(children), created_at=created_at)
+    
+    for index in range(posts):
+        post_comments = []
+        for _ in range(comments):
+            children = Comment.objects.insert([
+                comment(index) for _ in range(sub_comments)
+            ]) if sub_comments else []
+            post_comments.append(comment(index, children))
+        post_comments = Comment.objects.insert(post_comments) \
+            if post_comments else []
+        favorite_users = random.sample(authors, min(10, users))
+        Post(author=random.choice(authors), title="bench",
+             description="bench", comments=post_comments,
+             favorite_users=favorite_users,
+             favorite_user_ids=[user.id for user in favorite_users],
+             favorite_count=len(favorite_users),
+             created_at=index).save()
+
+
+def render_legacy(posts: list) -> str:
+    converted = []
+    for post in posts:
+        post.favorite_users = []
+        post.comments.sort(
+            key=lambda x: x.created_at, reverse=True)
+        converted.append(json.loads(post.to_json(
+            follow_reference=True, max_depth=3
+        )))
+    return json.dumps(converted)
+
+
+def render(posts: list) -> str:
+    return json.dumps(posts_blueprint.dictify_posts(posts))
+
+
+def measure(counter: QueryCounter, pages: int, per_page: int, legacy: bool):
+    """Returns (queries, cpu seconds, bytes) of each page."""
+    results = []
+    cursor = None
+    for _ in range(pages):
+        counter.count = 0
+        started_at = time.process_time()
+        
+        posts = Post.objects.order_by("-created_at", "-id")
+        if cursor:
+            created_at, post_id = posts_blueprint.decode_cursor(cursor)
+            posts = posts.filter(
+                Q(created_at__lt=created_at) |
+                Q(created_at=created_at, id__lt=post_id))
+        posts = posts.limit(per_page)
+        posts = list(posts) if legacy else list(
+            posts.exclude("favorite_users").as_pymongo())
+        if not posts:
+            break
+        body = render_legacy(posts) if legacy else render(posts)
+        
+        results.append((counter.count, time.process_time() - started_at,
+                        len(body)))
+        last = posts[-1]
+        cursor = posts_blueprint.encode_cursor(
+            dict(created_at=last.created_at, _id=last.id) if legacy
+            else last)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--posts", type=int, default=300)
+    parser.add_argument("--comments", type=int, default=5, help="per post")
+    parser.add_argument("--sub-comments", type=int, default=2, help="per comment")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--pages", type=int, default=5)
+    parser.add_argument("--per-page", type=int, default=posts_blueprint.POSTS_PER_PAGE)
+    parser.add_argument("--mongo-host", default="mongomock://localhost")
+    args = parser.parse_args()
+    
+    counter = QueryCounter()
+    monitoring.register(counter)
+    if args.mongo_host.startswith("mongomock://"):
+        counter.patch_mongomock()
+    connect("pingme-bench", host=args.mongo_host)
+    
+    User.drop_collection()
+    Post.drop_collection()
+    Comment.drop_collection()
+    seed(args.posts, args.comments, args.sub_comments, args.users)
+    
+    for name, legacy in (("to_json", True), ("dictify_posts", False)):
+        results = measure(counter, args.pages, args.per_page, legacy)
+        queries = [queries for queries, _, _ in results]
+        cpu = [seconds for _, seconds, _ in results]
+        size = [size for _, _, size in results]
+        print("{0}: pages: {1}, queries/page: {2:.1f}, cpu/page: {3:.1f} ms, "
+              "bytes/page: {4:.0f}".format(
+                  name, len(results), sum(queries) / len(results),
+                  sum(cpu) / len(results) * 1000, sum(size) / len(results)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Throughput benchmark of the push pipeline against the FCM stand-in.
+   push mode goes through the outbox, so pass --mongo-host of a real mongod
+   for its numbers; mongomock makes every claim a collection scan.
+    
+    python -m blueprints.test.bench_push --mode dispatch --rate 5000 --duration 10
+    python -m blueprints.test.bench_push --mode push --rate 1000 --mongo-host mongodb://127.0.0.1:27017
+    python -m blueprints.test.bench_push --mode send_message --rate 200 --tokens 3
+"""
+
+import argparse
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from mongoengine import connect
+from bson.objectid import ObjectId
+
+from blueprints import chat_rooms_blueprint
+from blueprints.test.fcm_stub import FcmStub
+from model.models import User
+from shared import message_service
+from shared import push_outbox
+
+
+def percentile(values: list, rank: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * rank))]
+
+
+def drive(rate: int, duration: float, send, concurrency: int):
+    """Calls send(index) at `rate` per second for `duration` seconds."""
+    total = int(rate * duration)
+    interval = 1.0 / rate
+    started_at = time.time()
+    
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for index in range(total):
+            delay = started_at + index * interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(send, index)
+    
+    return started_at, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--mode", choices=["dispatch", "push", "send_message"],
+                        default="dispatch")
+    parser.add_argument("--rate", type=int, default=500, help="pushes per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds")
+    parser.add_argument("--tokens", type=int, default=1, help="devices per user")
+    parser.add_argument("--latency", type=float, default=0.05, help="stub seconds per request")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--unregistered-rate", type=float, default=0.0)
+    parser.add_argument("--outbox-workers", type=int, default=1)
+    parser.add_argument("--dispatch-workers", type=int, default=message_service.WORKER_COUNT)
+    parser.add_argument("--concurrency", type=int, default=8, help="threads calling send_message")
+    parser.add_argument("--mongo-host", default="mongomock://localhost")
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+    
+    stub = FcmStub(latency=args.latency, error_rate=args.error_rate,
+                   unregistered_rate=args.unregistered_rate).start()
+    stub.init_app()
+    connect("pingme-bench", host=args.mongo_host)
+    message_service.start_workers(args.dispatch_workers)
+    
+    def tokens(index):
+        return ["bench-token-{0}-{1}".format(index, n) for n in range(args.tokens)]
+    
+    if args.mode == "dispatch":
+        def send(index):
+            message_service.dispatch(dict(sent_at=str(time.time())), tokens(index))
+    elif args.mode == "push":
+        push_outbox.start(args.outbox_workers)
+        
+        def send(index):
+            message_service.push(dict(sent_at=str(time.time())), tokens(index))
+    else:
+        user = User(id=ObjectId(), nick_name="bench")
+        
+        def send(index):
+            chat_rooms_blueprint.send_message(
+                chat_room_id=ObjectId(), user=user,
+                message="bench", message_id=ObjectId(),
+                registration_tokens=tokens(index), created_at=time.time())
+    
+    started_at, total = drive(args.rate, args.duration, send, args.concurrency)
+    expected = total * args.tokens
+    
+    deadline = time.time() + args.timeout
+    while len(stub.received) < expected and time.time() < deadline:
+        time.sleep(0.05)
+    
+    push_outbox.stop()
+    message_service.shutdown()
+    stub.stop()
+    
+    key = "created_at" if args.mode == "send_message" else "sent_at"
+    received = list(stub.received)
+    latencies = [
+        received_at - float(message["data"][key])
+        for received_at, message in received
+    ]
+    elapsed = max((received_at for received_at, _ in received), default=started_at) - started_at
+    
+    print("mode: {0}, offered: {1} pushes/s, messages: {2}/{3}".format(
+        args.mode, args.rate, len(received), expected))
+    print("throughput: {0:.1f} messages/s, http requests: {1}".format(
+        len(received) / elapsed if elapsed > 0 else 0.0, stub.requests))
+    print("latency p50: {0:.1f} ms, p90: {1:.1f} ms, p99: {2:.1f} ms, max: {3:.1f} ms".format(
+        *(percentile(latencies, rank) * 1000 for rank in (0.5, 0.9, 0.99, 1.0))))
+    print("message_service: {0}".format(message_service.get_stats()))
+
+
+if __name__ == "__main__":
+    main()
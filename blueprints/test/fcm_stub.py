@@ -0,0 +1,192 @@
+"""Local stand-in of the FCM v1 send and batch endpoints."""
+
+import email.parser
+import firebase_admin
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+import uuid
+
+from firebase_admin import credentials
+from firebase_admin import messaging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PROJECT_ID = "pingme-local"
+# a key for the stub only, the tokens signed by it are never verified.
+PRIVATE_KEY_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "testdata/fcm_stub_key.pem")
+
+ERRORS = {
+    "UNREGISTERED": (404, "NOT_FOUND"),
+    "INVALID_ARGUMENT": (400, "INVALID_ARGUMENT"),
+    "UNAVAILABLE": (503, "UNAVAILABLE")
+}
+
+
+class FcmStub(object):
+    """Answers pushes after `latency` seconds per HTTP request.
+       The tokens in `unregistered_tokens` or picked by `unregistered_rate`
+       are answered UNREGISTERED, `error_rate` of the others UNAVAILABLE.
+       Messaging calls this stub from start() until stop(), or in a with
+       block, then the FCM endpoints are restored.
+    """
+    
+    def __init__(self, latency=0.0, error_rate=0.0,
+                 unregistered_rate=0.0, unregistered_tokens=()):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.unregistered_rate = unregistered_rate
+        self.unregistered_tokens = set(unregistered_tokens)
+        
+        self.requests = 0
+        self.received = []  # (received_at, message) of the messages
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+        self._urls = None
+    
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return "http://{host}:{port}".format(host=host, port=port)
+    
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        
+        # the batch endpoint is read from the class on every send_all.
+        service = messaging._MessagingService
+        self._urls = (service.FCM_URL, service.FCM_BATCH_URL)
+        service.FCM_URL = self.url + "/v1/projects/{0}/messages:send"
+        service.FCM_BATCH_URL = self.url + "/batch"
+        return self
+    
+    def stop(self):
+        if self._urls:
+            service = messaging._MessagingService
+            service.FCM_URL, service.FCM_BATCH_URL = self._urls
+            self._urls = None
+        self._server.shutdown()
+        self._server.server_close()
+    
+    def __enter__(self):
+        return self.start()
+    
+    def __exit__(self, *args):
+        self.stop()
+    
+    def init_app(self, name=firebase_admin._DEFAULT_APP_NAME):
+        """Initializes a firebase app whose messaging calls this stub,
+           the stub has to be started first.
+        """
+        with open(PRIVATE_KEY_PATH) as key_file:
+            private_key = key_file.read()
+        cred = credentials.Certificate(dict(
+            type="service_account",
+            project_id=PROJECT_ID,
+            private_key_id="fcm-stub",
+            private_key=private_key,
+            client_email="fcm-stub@{0}.iam.gserviceaccount.com".format(
+                PROJECT_ID),
+            client_id="0",
+            token_uri=self.url + "/token"))
+        return firebase_admin.initialize_app(
+            cred, dict(projectId=PROJECT_ID), name=name)
+    
+    def answer(self, message: dict) -> tuple:
+        """Returns (status, body) for a single message."""
+        with self._lock:
+            self.received.append((time.time(), message))
+        
+        token = message.get("token")
+        if token in self.unregistered_tokens or \
+                random.random() < self.unregistered_rate:
+            return self.error("UNREGISTERED")
+        if random.random() < self.error_rate:
+            return self.error("UNAVAILABLE")
+        
+        return 200, dict(name="projects/{0}/messages/{1}".format(
+            PROJECT_ID, next(self._ids)))
+    
+    @staticmethod
+    def error(code) -> tuple:
+        status, status_name = ERRORS[code]
+        details = [dict(errorCode=code)]
+        details[0]["@type"] = "type.googleapis.com/google.firebase.fcm.v1.FcmError"
+        return status, dict(error=dict(
+            code=status, message=code, status=status_name, details=details))
+    
+    def _handler(self):
+        stub = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            
+            def log_message(self, *args):
+                pass
+            
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                with stub._lock:
+                    stub.requests += 1
+                time.sleep(stub.latency)
+                
+                if self.path == "/token":
+                    self.reply(200, dict(
+                        access_token="fcm-stub", token_type="Bearer",
+                        expires_in=3600))
+                elif self.path == "/batch":
+                    self.reply_batch(body)
+                elif self.path.endswith("/messages:send"):
+                    self.reply(*stub.answer(json.loads(body)["message"]))
+                else:
+                    self.reply(404, dict(error=dict(
+                        code=404, message="Not found.", status="NOT_FOUND")))
+            
+            def reply(self, status, payload, content_type="application/json"):
+                body = payload if isinstance(payload, bytes) \
+                    else json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            
+            def reply_batch(self, body):
+                header = "Content-Type: {0}\r\n\r\n".format(
+                    self.headers["Content-Type"]).encode()
+                batch = email.parser.BytesParser().parsebytes(header + body)
+                
+                boundary = uuid.uuid4().hex
+                parts = []
+                for part in batch.get_payload():
+                    request = part.get_payload()
+                    message = json.loads(
+                        re.split(r"\r?\n\r?\n", request, 1)[1])["message"]
+                    status, payload = stub.answer(message)
+                    parts.append(
+                        "--{boundary}\r\n"
+                        "Content-Type: application/http\r\n"
+                        "Content-ID: <response-{content_id}>\r\n\r\n"
+                        "HTTP/1.1 {status} {reason}\r\n"
+                        "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+                        "{payload}\r\n".format(
+                            boundary=boundary,
+                            content_id=part["Content-ID"][1:-1],
+                            status=status,
+                            reason=self.responses[status][0],
+                            payload=json.dumps(payload)))
+                parts.append("--{boundary}--\r\n".format(boundary=boundary))
+                
+                self.reply(
+                    200, "".join(parts).encode(),
+                    content_type="multipart/mixed; boundary={0}".format(
+                        boundary))
+        
+        return Handler
@@ -0,0 +1,236 @@
+import firebase_admin
+import gzip
+import json
+import mock
+import mongomock
+import os
+import pendulum
+import struct
+import tempfile
+import unittest
+
+from bson.objectid import ObjectId
+from mongoengine import connect, disconnect
+from main import app
+from blueprints.test.mock_data import *
+from config import UnitTestConfig
+from google.api_core.exceptions import PreconditionFailed
+from model.models import User, ChatRoom, ChatMessage
+from shared import chat_archive
+from shared import message_service
+from shared.instances import init_firebase
+
+DAY = 24 * 60 * 60
+
+
+def object_id(timestamp: int) -> ObjectId:
+    """An id made at the given time like the message created then."""
+    return ObjectId(struct.pack(">I", timestamp) + os.urandom(8))
+
+
+class ChatArchiveTestCase(unittest.TestCase):
+    
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.firebase_app = init_firebase(UnitTestConfig)
+    
+    @classmethod
+    def tearDownClass(cls) -> None:
+        firebase_admin.delete_app(cls.firebase_app)
+    
+    def setUp(self) -> None:
+        connect("mongoenginetest", host="mongomock://localhost")
+        app.config.from_object(UnitTestConfig)
+        app.app_context().push()
+        self.app = app.test_client()
+        
+        self.directory = tempfile.TemporaryDirectory()
+        self.storage = chat_archive.LocalStorage(self.directory.name)
+        patcher = mock.patch.object(chat_archive, "storage", self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        
+        pendulum.set_test_now(pendulum.datetime(2020, 5, 21, 12))
+        
+        self.user = User(uid=mock_user_1["uid"], nick_name="user_1").save()
+        self.chat_room = ChatRoom(
+            members=[self.user], members_history=[self.user],
+            created_at=pendulum.now().int_timestamp).save()
+        
+        # 40 messages a week apart, the latest 10 of them in the hot window.
+        started_at = pendulum.now().subtract(weeks=39).int_timestamp
+        self.messages = [
+            ChatMessage(
+                id=object_id(started_at + index * 7 * DAY),
+                chat_room=self.chat_room, user_id=self.user.id,
+                message="message_{0}".format(index),
+                created_at=started_at + index * 7 * DAY).save()
+            for index in range(40)
+        ]
+    
+    def tearDown(self):
+        pendulum.set_test_now()
+        self.directory.cleanup()
+        disconnect()
+    
+    def list_messages(self, **params) -> list:
+        response = self.app.get(
+            "/chat_rooms/{room_id}/messages".format(room_id=self.chat_room.id),
+            query_string=params, headers=dict(uid=self.user.uid))
+        self.assertEqual(response.status_code, 200)
+        return [message["message"] for message in response.get_json()]
+    
+    def test_archive_messages(self):
+        # nothing is deleted unless its segment is written.
+        with mock.patch.object(self.storage, "append",
+                               side_effect=PreconditionFailed("changed")):
+            with self.assertRaises(PreconditionFailed):
+                chat_archive.archive_messages(age=9 * 7 * DAY, batch_size=7)
+        self.assertEqual(ChatMessage.objects.count(), 40)
+        
+        archived = chat_archive.archive_messages(age=9 * 7 * DAY, batch_size=7)
+        self.assertEqual(archived, 30)
+        self.assertEqual(
+            [message.message for message in
+             ChatMessage.objects.order_by("created_at")],
+            ["message_{0}".format(index) for index in range(30, 40)])
+        self.assertEqual(
+            ChatRoom.objects.get(id=self.chat_room.id).archived_until,
+            self.messages[29].created_at)
+        
+        # a compressed segment per month of the room.
+        segments = sorted(self.storage.list(chat_archive.get_segment_name(
+            self.chat_room.id, "")[:-len(".jsonl.gz")]))
+        self.assertEqual(len(segments), 8)
+        data = self.storage.read(segments[0])
+        self.assertIn(b"message_0", gzip.decompress(data))
+        
+        # a run failed before deleting leaves duplicates the reader skips.
+        self.storage.append(segments[0], data)
+        self.assertEqual(
+            [message["message"] for message in
+             chat_archive.read_segment(segments[0])],
+            ["message_0", "message_1"])
+    
+    @mock.patch.object(message_service, "dispatch")
+    def test_create_messages_archived_meanwhile(self, dispatch):
+        def post(client_ids):
+            response = self.app.post(
+                "/chat_rooms/{room_id}/messages".format(
+                    room_id=self.chat_room.id),
+                data=json.dumps(dict(messages=[
+                    dict(client_id=client_id, message=client_id)
+                    for client_id in client_ids
+                ])),
+                headers=dict(uid=self.user.uid),
+                content_type="application/json")
+            self.assertEqual(response.status_code, 200)
+            return response.get_json()
+        
+        sent = post(["client_0"])
+        
+        # the message is archived right after the retry found it stored.
+        insert_many = mongomock.collection.Collection.insert_many
+        
+        def insert_then_archive(collection, *args, **kwargs):
+            try:
+                return insert_many(collection, *args, **kwargs)
+            finally:
+                chat_archive.archive_messages(age=-1)
+        
+        with mock.patch.object(
+                mongomock.collection.Collection, "insert_many",
+                autospec=True, side_effect=insert_then_archive):
+            resent = post(["client_0", "client_1"])
+        
+        self.assertEqual(resent[0], sent[0])
+        self.assertEqual(resent[1]["client_id"], "client_1")
+        self.assertEqual(ChatMessage.objects.count(), 0)
+        
+        # the archive keeps the client ids to itself.
+        archived = chat_archive.list_archived_messages(self.chat_room.id)
+        self.assertEqual(len(archived), 42)
+        self.assertFalse(any("client_id" in message for message in archived))
+    
+    @mock.patch.object(chat_archive.firebase_storage, "bucket")
+    def test_append_to_bucket(self, bucket):
+        blobs = {}
+        
+        def get_blob(name):
+            return blobs.get(name)
+        
+        def new_blob(name):
+            blob = mock.Mock(generation=None)
+            blob.name = name
+            
+            def upload_from_string(data, content_type=None,
+                                   if_generation_match=None):
+                if if_generation_match == 0 and name in blobs:
+                    raise PreconditionFailed("exists")
+                blob.data, blob.generation = data, 1
+                blobs[name] = blob
+            
+            def compose(sources, if_generation_match=None):
+                for source, generation in zip(sources, if_generation_match):
+                    if generation is not None and \
+                            blobs[source.name].generation != generation:
+                        raise PreconditionFailed("changed")
+                blob.data = b"".join(blobs[source.name].data for source in sources)
+                blob.generation += 1
+            
+            blob.upload_from_string.side_effect = upload_from_string
+            blob.compose.side_effect = compose
+            blob.delete.side_effect = lambda: blobs.pop(name, None)
+            return blob
+        
+        bucket.return_value.get_blob.side_effect = get_blob
+        bucket.return_value.blob.side_effect = new_blob
+        storage = chat_archive.BucketStorage()
+        
+        storage.append("segment", b"a")
+        self.assertEqual(blobs["segment"].data, b"a")
+        
+        # another run appends in between, read again not to overwrite it.
+        read = blobs["segment"]
+        stale = mock.Mock(generation=read.generation, data=read.data)
+        stale.name = "segment"
+        stale.compose.side_effect = lambda sources, if_generation_match: \
+            read.compose(sources, if_generation_match=if_generation_match)
+        storage.append("segment", b"b")
+        bucket.return_value.get_blob.side_effect = [stale, blobs["segment"]]
+        storage.append("segment", b"c")
+        self.assertEqual(blobs["segment"].data, b"abc")
+        self.assertEqual(sorted(blobs), ["segment"])
+    
+    def test_list_archived_messages(self):
+        chat_archive.archive_messages(age=9 * 7 * DAY)
+        expected = ["message_{0}".format(index) for index in reversed(range(40))]
+        
+        # pages go on from the hot messages to the archived ones.
+        pages, before = [], None
+        while True:
+            page = self.list_messages(
+                limit=15, **(dict(before=before) if before else {}))
+            if not page:
+                break
+            pages.append(page)
+            before = str(self.messages[int(page[-1].split("_")[1])].id)
+        self.assertEqual([len(page) for page in pages], [15, 15, 10])
+        self.assertEqual(sum(pages, []), expected)
+        
+        # the messages right after an archived cursor, into the hot ones.
+        after = str(self.messages[26].id)
+        self.assertEqual(
+            self.list_messages(after=after, limit=5),
+            ["message_31", "message_30", "message_29", "message_28", "message_27"])
+        
+        before = str(self.messages[12].id)
+        self.assertEqual(
+            self.list_messages(after=after, before=before), [])
+        self.assertEqual(
+            self.list_messages(after=str(self.messages[8].id), before=before),
+            ["message_11", "message_10", "message_9"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,15 +3,24 @@ import json
 import unittest
 import pendulum
 import mock
+import mongomock
+import threading
 
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+from bson.objectid import ObjectId
 from mongoengine import connect, disconnect
 from main import app
 from blueprints.test.mock_data import *
 from config import UnitTestConfig
-from model.models import User, ChatRoom
+from blueprints import chat_rooms_blueprint
+from model.models import User, ChatRoom, ChatMessage, PushJob, DeadPushJob
+from shared import message_service
+from shared import push_outbox
 from shared.instances import init_firebase
 
 from firebase_admin import auth
+from firebase_admin import exceptions
 from firebase_admin import messaging
 
 REQUEST_TYPE_LIKE = 10
@@ -90,7 +99,6 @@ class UsersBlueprintTestCase(unittest.TestCase):
             title=None,
             members=[user_1, user_2],
             members_history=[user_1, user_2],
-            messages=[],
             created_at=pendulum.now().int_timestamp).save()
         
         first_message = "first_message 1"
@@ -108,8 +116,7 @@ class UsersBlueprintTestCase(unittest.TestCase):
             headers=dict(uid=user_1.uid),
             content_type='application/json')
         
-        chat_room = ChatRoom.objects.first()
-        messages = chat_room.messages
+        messages = ChatMessage.objects(chat_room=chat_room).order_by("created_at", "id")
         # assert messages
         self.assertEqual(len(messages), 2)
         self.assertEqual(str(messages[0].user_id), str(user_1.id))
@@ -145,7 +152,6 @@ class UsersBlueprintTestCase(unittest.TestCase):
             title=None,
             members=[user_1, user_2],
             members_history=[user_1, user_2],
-            messages=[],
             created_at=pendulum.now().int_timestamp).save()
         
         self.app.post("/chat_rooms/{room_id}/messages/test_message_1".format(
@@ -178,6 +184,465 @@ class UsersBlueprintTestCase(unittest.TestCase):
         
         self.assertEqual(members[1]["uid"], user_2.uid)
         self.assertEqual(members[1]["nick_name"], user_2.nick_name)
+    
+    
+    def test_list_messages(self):
+        user_1 = User(uid=mock_user_1["uid"], nick_name="user_1").save()
+        outsider = User(uid=mock_user_3["uid"], nick_name="user_3").save()
+        chat_room = ChatRoom(
+            members=[user_1], members_history=[user_1],
+            created_at=pendulum.now().int_timestamp).save()
+        created_at = pendulum.now().int_timestamp
+        for index in range(75):
+            # two messages in a second, the id breaks the ties.
+            ChatMessage(chat_room=chat_room, user_id=user_1.id,
+                        message="message_{0}".format(index),
+                        created_at=created_at + index // 2).save()
+        
+        def list_messages(**params):
+            response = self.app.get(
+                "/chat_rooms/{room_id}/messages".format(room_id=chat_room.id),
+                query_string=params, headers=dict(uid=user_1.uid))
+            self.assertEqual(response.status_code, 200)
+            return [message["message"] for message in response.get_json()]
+        
+        # the latest page first, then older pages by the cursor.
+        pages, before = [], None
+        while True:
+            page = list_messages(**(dict(before=before) if before else {}))
+            if not page:
+                break
+            pages.append(page)
+            before = ChatMessage.objects.get(message=page[-1]).id
+        self.assertEqual([len(page) for page in pages], [30, 30, 15])
+        self.assertEqual(
+            sum(pages, []),
+            ["message_{0}".format(index) for index in reversed(range(75))])
+        
+        # messages right after a cursor, still newest first.
+        after = ChatMessage.objects.get(message="message_10").id
+        self.assertEqual(
+            list_messages(after=after, limit=3),
+            ["message_13", "message_12", "message_11"])
+        
+        before = ChatMessage.objects.get(message="message_14").id
+        self.assertEqual(
+            list_messages(after=after, before=before),
+            ["message_13", "message_12", "message_11"])
+        
+        response = self.app.get(
+            "/chat_rooms/{room_id}/messages".format(room_id=chat_room.id),
+            headers=dict(uid=outsider.uid))
+        self.assertEqual(response.status_code, 404)
+        
+        for query in (dict(limit="ten"), dict(before="invalid"),
+                      dict(after="invalid")):
+            response = self.app.get(
+                "/chat_rooms/{room_id}/messages".format(room_id=chat_room.id),
+                query_string=query, headers=dict(uid=user_1.uid))
+            self.assertEqual(response.status_code, 400)
+    
+    @mock.patch.object(message_service, "dispatch")
+    def test_list_inbox(self, dispatch):
+        # the unread counts are read by the range after the last read id.
+        self.assertIn([("chat_room", 1), ("_id", 1)], ChatMessage.list_indexes())
+        
+        user_1 = User(uid=mock_user_1["uid"], nick_name="user_1").save()
+        user_2 = User(uid=mock_user_2["uid"], nick_name="user_2").save()
+        user_3 = User(uid=mock_user_3["uid"], nick_name="user_3").save()
+        created_at = pendulum.now().int_timestamp
+        chat_room_1 = ChatRoom(
+            members=[user_1, user_2], members_history=[user_1, user_2],
+            created_at=created_at).save()
+        chat_room_2 = ChatRoom(
+            members=[user_1, user_3], members_history=[user_1, user_3],
+            created_at=created_at).save()
+        ChatRoom(members=[user_2, user_3], members_history=[user_2, user_3],
+                 created_at=created_at).save()
+        
+        def post(chat_room, user, message):
+            self.app.post("/chat_rooms/{room_id}/messages/{message}".format(
+                room_id=chat_room.id, message=message), headers=dict(uid=user.uid))
+        
+        pendulum.set_test_now(pendulum.from_timestamp(created_at + 1))
+        post(chat_room_1, user_2, "message_1")
+        post(chat_room_1, user_1, "message_2")
+        post(chat_room_1, user_2, "message_3")
+        pendulum.set_test_now(pendulum.from_timestamp(created_at + 2))
+        post(chat_room_2, user_3, "message_4")
+        post(chat_room_2, user_3, "message_5")
+        pendulum.set_test_now()
+        
+        response = self.app.get("/chat_rooms/inbox", headers=dict(uid=user_1.uid))
+        inbox = response.get_json()
+        
+        # the room with the latest message comes first.
+        self.assertEqual(
+            [room["id"] for room in inbox], [str(chat_room_2.id), str(chat_room_1.id)])
+        self.assertEqual(inbox[0]["last_message"]["message"], "message_5")
+        self.assertEqual(inbox[1]["last_message"]["message"], "message_3")
+        
+        # counts the messages of others after the last one user_1 posted.
+        self.assertEqual(inbox[0]["unread_count"], 2)
+        self.assertEqual(inbox[1]["unread_count"], 1)
+        
+        # members are cards without the uid.
+        self.assertEqual(
+            sorted(member["nick_name"] for member in inbox[1]["members"]),
+            ["user_1", "user_2"])
+        self.assertEqual(
+            set(inbox[1]["members"][0].keys()), {"id", "nick_name", "image_url"})
+        self.assertNotIn("messages", inbox[0])
+    
+    @mock.patch.object(message_service, "dispatch")
+    def test_update_last_read_message(self, dispatch):
+        user_1 = User(uid=mock_user_1["uid"], nick_name="user_1").save()
+        user_2 = User(uid=mock_user_2["uid"], nick_name="user_2").save()
+        outsider = User(uid=mock_user_3["uid"], nick_name="user_3").save()
+        chat_room = ChatRoom(
+            members=[user_1, user_2], members_history=[user_1, user_2],
+            created_at=pendulum.now().int_timestamp).save()
+        
+        message_ids = [
+            self.app.post("/chat_rooms/{room_id}/messages/message_{index}".format(
+                room_id=chat_room.id, index=index),
+                headers=dict(uid=user_2.uid)).get_json()["id"]
+            for index in range(3)
+        ]
+        
+        def update(message_id, user=user_1):
+            return self.app.put("/chat_rooms/{room_id}/read/{message_id}".format(
+                room_id=chat_room.id, message_id=message_id),
+                headers=dict(uid=user.uid))
+        
+        response = self.app.get("/chat_rooms/{room_id}/read".format(
+            room_id=chat_room.id), headers=dict(uid=user_1.uid))
+        self.assertEqual(response.get_json()["unread_count"], 3)
+        self.assertEqual(
+            response.get_json()["last_read_message_ids"],
+            {str(user_2.id): message_ids[2]})
+        
+        read_state = update(message_ids[1]).get_json()
+        self.assertEqual(read_state["unread_count"], 1)
+        self.assertEqual(
+            read_state["last_read_message_ids"][str(user_1.id)], message_ids[1])
+        
+        # an older read never moves the pointer back.
+        read_state = update(message_ids[0]).get_json()
+        self.assertEqual(read_state["unread_count"], 1)
+        self.assertEqual(
+            read_state["last_read_message_ids"][str(user_1.id)], message_ids[1])
+        
+        self.assertEqual(update(message_ids[2]).get_json()["unread_count"], 0)
+        self.assertEqual(update(message_ids[2], user=outsider).status_code, 404)
+        self.assertNotIn(
+            str(outsider.id),
+            ChatRoom.objects.get(id=chat_room.id).last_read_message_ids)
+    
+    @mock.patch.object(message_service, "dispatch")
+    def test_stream_messages(self, dispatch):
+        user_1 = User(uid=mock_user_1["uid"], nick_name="user_1").save()
+        user_2 = User(uid=mock_user_2["uid"], nick_name="user_2").save()
+        user_3 = User(uid=mock_user_3["uid"], nick_name="user_3",
+                      r_token=mock_user_3["r_token"]).save()
+        chat_room = ChatRoom(
+            members=[user_1, user_2, user_3],
+            members_history=[user_1, user_2, user_3],
+            created_at=pendulum.now().int_timestamp).save()
+        
+        def post(message):
+            return self.app.post("/chat_rooms/{room_id}/messages/{message}".format(
+                room_id=chat_room.id, message=message), headers=dict(uid=user_1.uid))
+        
+        post("message_0")
+        
+        response = self.app.get(
+            "/chat_rooms/stream?since=0", headers=dict(uid=user_2.uid))
+        stream = (event.decode() if isinstance(event, bytes) else event
+                  for event in response.response)
+        
+        # the messages posted since the given time come first.
+        self.assertIn("message_0", next(stream))
+        
+        # then the messages posted while the stream is open.
+        dispatch.reset_mock()
+        post("message_1")
+        event = next(stream)
+        self.assertIn("event: message", event)
+        self.assertIn("message_1", event)
+        self.assertIn(str(chat_room.id), event)
+        
+        # only the member not streaming is pushed through FCM.
+        self.assertEqual(dispatch.call_count, 1)
+        self.assertEqual(dispatch.call_args[0][1], [user_3.r_token])
+        
+        response.close()
+        
+        response = self.app.get(
+            "/chat_rooms/stream?since=yesterday", headers=dict(uid=user_2.uid))
+        self.assertEqual(response.status_code, 400)
+    
+    @mock.patch.object(push_outbox, "get_backoff", return_value=0)
+    @mock.patch.object(message_service, "dispatch")
+    def test_send_message(self, dispatch, get_backoff):
+        user_1 = User(uid=mock_user_1["uid"], nick_name="user_1").save()
+        failing_tokens = {"failed_device_token"}
+        
+        def dispatch_once(data, tokens):
+            future = Future()
+            future.set_result(messaging.BatchResponse([
+                messaging.SendResponse(
+                    None, exceptions.UnavailableError("unavailable"))
+                if token in failing_tokens else
+                messaging.SendResponse(dict(name="projects/pingme/messages/0"), None)
+                for token in tokens
+            ]))
+            return future
+        
+        dispatch.side_effect = dispatch_once
+        tokens = ["device_token_{0}".format(index) for index in range(10)]
+        
+        chat_rooms_blueprint.send_message(
+            chat_room_id=ObjectId(), user=user_1, message="test_message",
+            message_id=ObjectId(), created_at=pendulum.now().int_timestamp,
+            registration_tokens=tokens + ["failed_device_token"])
+        
+        # a payload and a multicast for every recipient at once.
+        data, sent_tokens = dispatch.call_args[0]
+        self.assertEqual(sent_tokens, tokens + ["failed_device_token"])
+        self.assertEqual(data["nick_name"], "user_1")
+        self.assertEqual(data["message"], "test_message")
+        self.assertNotIn("push_id", data)
+        
+        # only the failed token is left to the outbox, one attempt made.
+        job = PushJob.objects.get()
+        self.assertEqual(job.tokens, ["failed_device_token"])
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(job.data, data)
+        
+        # which retries it until it goes to the dead letters.
+        for _ in range(push_outbox.MAX_ATTEMPTS - 1):
+            self.assertEqual(push_outbox.process_outbox(dispatch_once), 1)
+        self.assertEqual(PushJob.objects.count(), 0)
+        self.assertEqual(
+            DeadPushJob.objects.get().tokens, ["failed_device_token"])
+        self.assertEqual(dispatch.call_count, 1)
+    
+    @mock.patch.object(message_service, "dispatch")
+    def test_create_messages(self, dispatch):
+        user_1 = User(uid=mock_user_1["uid"], nick_name="user_1").save()
+        user_2 = User(uid=mock_user_2["uid"], nick_name="user_2",
+                      r_token=mock_user_2["r_token"]).save()
+        chat_room = ChatRoom(
+            members=[user_1, user_2], members_history=[user_1, user_2],
+            created_at=pendulum.now().int_timestamp).save()
+        
+        def post(messages, user=user_1):
+            return self.app.post(
+                "/chat_rooms/{room_id}/messages".format(room_id=chat_room.id),
+                data=json.dumps(dict(messages=messages)),
+                headers=dict(uid=user.uid), content_type="application/json")
+        
+        queued = [
+            dict(client_id="client_{0}".format(index),
+                 message="message_{0}".format(index))
+            for index in range(3)
+        ]
+        created = post(queued).get_json()
+        self.assertEqual(
+            [message["message"] for message in created],
+            ["message_0", "message_1", "message_2"])
+        self.assertEqual(ChatMessage.objects(chat_room=chat_room).count(), 3)
+        self.assertEqual(
+            str(ChatRoom.objects.get(id=chat_room.id).last_message.id),
+            created[-1]["id"])
+        self.assertEqual(
+            str(ChatRoom.objects.get(
+                id=chat_room.id).last_read_message_ids[str(user_1.id)]),
+            created[-1]["id"])
+        
+        # a notification for the whole batch.
+        self.assertEqual(dispatch.call_count, 1)
+        data, tokens = dispatch.call_args[0]
+        self.assertEqual(tokens, [user_2.r_token])
+        self.assertEqual(data["message"], "message_2")
+        self.assertEqual(data["count"], "3")
+        
+        # the messages sent again are stored once with the same ids.
+        resent = post(queued + [dict(client_id="client_3", message="message_3")])
+        self.assertEqual(
+            [message["id"] for message in resent.get_json()[:3]],
+            [message["id"] for message in created])
+        self.assertEqual(ChatMessage.objects(chat_room=chat_room).count(), 4)
+        self.assertEqual(dispatch.call_count, 2)
+        self.assertEqual(dispatch.call_args[0][0]["count"], "1")
+        
+        # client ids of other users or in other rooms never collide.
+        post(queued[:1], user=user_2)
+        self.assertEqual(ChatMessage.objects(chat_room=chat_room).count(), 5)
+        other_room = ChatRoom(
+            members=[user_1, user_2], members_history=[user_1, user_2],
+            created_at=pendulum.now().int_timestamp).save()
+        response = self.app.post(
+            "/chat_rooms/{room_id}/messages".format(room_id=other_room.id),
+            data=json.dumps(dict(messages=queued[:1])),
+            headers=dict(uid=user_1.uid), content_type="application/json")
+        self.assertNotEqual(response.get_json()[0]["id"], created[0]["id"])
+        self.assertEqual(ChatMessage.objects(chat_room=other_room).count(), 1)
+        
+        self.assertEqual(post([]).status_code, 400)
+        self.assertEqual(post([dict(client_id="client_5")]).status_code, 400)
+        self.assertEqual(post([dict(client_id=5, message="message_5")]).status_code, 400)
+        self.assertEqual(post(["message_5"]).status_code, 400)
+        self.assertEqual(post(queued * 34).status_code, 400)
+        response = self.app.post(
+            "/chat_rooms/{room_id}/messages".format(room_id=chat_room.id),
+            data="messages", headers=dict(uid=user_1.uid),
+            content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(ChatMessage.objects(chat_room=chat_room).count(), 5)
+    
+    def test_delete_chat_room_messages(self):
+        chat_room = ChatRoom(created_at=pendulum.now().int_timestamp).save()
+        ChatMessage(chat_room=chat_room, message="test_message",
+                    created_at=pendulum.now().int_timestamp).save()
+        
+        chat_room.delete()
+        self.assertEqual(ChatMessage.objects.count(), 0)
+    
+    def test_migrate_chat_messages(self):
+        created_at = pendulum.now().int_timestamp
+        legacy_messages = [
+            dict(id=ObjectId(), user_id=ObjectId(),
+                 message="test_message_{0}".format(index),
+                 created_at=created_at + index)
+            for index in range(5)
+        ]
+        room_id = ChatRoom._get_collection().insert_one(dict(
+            title=None, created_at=created_at, available=False,
+            messages=legacy_messages)).inserted_id
+        
+        # a room still embedding messages is readable before migration.
+        self.assertEqual(ChatRoom.objects.get(id=room_id).created_at, created_at)
+        
+        chat_rooms_blueprint.migrate_chat_messages(batch_size=2)
+        # runs again without duplicates when interrupted.
+        ChatRoom._get_collection().update_one(
+            dict(_id=room_id), {"$set": dict(messages=legacy_messages)})
+        chat_rooms_blueprint.migrate_chat_messages(batch_size=2)
+        
+        messages = ChatMessage.objects(chat_room=room_id).order_by("created_at")
+        self.assertEqual(
+            [message.id for message in messages],
+            [message["id"] for message in legacy_messages])
+        self.assertEqual(messages[0].message, "test_message_0")
+        self.assertNotIn(
+            "messages", ChatRoom._get_collection().find_one(dict(_id=room_id)))
+        self.assertEqual(
+            ChatRoom.objects.get(id=room_id).last_message.id,
+            legacy_messages[-1]["id"])
+    
+    def test_migrate_chat_messages_after_new_message(self):
+        created_at = pendulum.now().int_timestamp
+        legacy_messages = [
+            dict(id=ObjectId(), user_id=ObjectId(),
+                 message="test_message_{0}".format(index),
+                 created_at=created_at - 10 + index)
+            for index in range(3)
+        ]
+        room_id = ChatRoom._get_collection().insert_one(dict(
+            title=None, created_at=created_at - 10, available=False,
+            messages=legacy_messages)).inserted_id
+        
+        # a message posted after the deploy, before the migration ran.
+        user = User(uid=mock_user_1["uid"], nick_name="user_1").save()
+        message = ChatMessage(
+            chat_room=room_id, user_id=user.id, message="new_message",
+            created_at=created_at).save()
+        chat_rooms_blueprint.update_last_message(
+            ChatRoom.objects.get(id=room_id), user, message)
+        
+        chat_rooms_blueprint.migrate_chat_messages()
+        
+        last_message = ChatRoom.objects.get(id=room_id).last_message
+        self.assertEqual(last_message.id, message.id)
+        self.assertEqual(last_message.message, "new_message")
+        self.assertEqual(ChatMessage.objects(chat_room=room_id).count(), 4)
+    
+    @mock.patch.object(message_service, "dispatch")
+    def test_create_message_concurrently(self, dispatch):
+        user_1 = User(uid=mock_user_1["uid"], nick_name="user_1").save()
+        user_2 = User(uid=mock_user_2["uid"], nick_name="user_2").save()
+        outsider = User(uid=mock_user_3["uid"], nick_name="user_3").save()
+        chat_room = ChatRoom(
+            members=[user_1, user_2], members_history=[user_1, user_2],
+            created_at=pendulum.now().int_timestamp).save()
+        
+        def post(index):
+            user = (user_1, user_2)[index % 2]
+            response = app.test_client().post(
+                "/chat_rooms/{room_id}/messages/message_{index}".format(
+                    room_id=chat_room.id, index=index),
+                headers=dict(uid=user.uid))
+            self.assertEqual(response.status_code, 200)
+            return response.get_json()
+        
+        # a write is atomic on the server but not in mongomock.
+        lock = threading.Lock()
+        collection = mongomock.collection.Collection
+        writes = Counter()
+        
+        def atomic(name):
+            write = getattr(collection, name)
+            
+            def locked(*args, **kwargs):
+                with lock:
+                    writes[name] += 1
+                    return write(*args, **kwargs)
+            return mock.patch.object(collection, name, locked)
+        
+        with atomic("find_one_and_update"), atomic("update_one"), \
+                ThreadPoolExecutor(max_workers=8) as executor:
+            created = list(executor.map(post, range(200)))
+        
+        # a write per post checks the membership and moves the read
+        # pointer, another previews the message.
+        self.assertEqual(
+            writes, Counter(find_one_and_update=200, update_one=200))
+        
+        # no message is lost or overwritten by the others.
+        self.assertEqual(
+            sorted(message["message"] for message in created),
+            sorted("message_{0}".format(index) for index in range(200)))
+        self.assertEqual(ChatMessage.objects(chat_room=chat_room).count(), 200)
+        
+        # the newest message is previewed whatever order the writes land.
+        newest = ChatMessage.objects(chat_room=chat_room).order_by(
+            "-created_at", "-id").first()
+        self.assertEqual(
+            ChatRoom.objects.get(id=chat_room.id).last_message.id, newest.id)
+        
+        delayed = ChatMessage(
+            id=ObjectId(), chat_room=chat_room, user_id=user_1.id,
+            message="delayed", created_at=newest.created_at - 1)
+        last_read_message_id = ChatRoom.objects.get(
+            id=chat_room.id).last_read_message_ids[str(user_1.id)]
+        delayed.id = ObjectId.from_datetime(
+            last_read_message_id.generation_time.replace(year=2000))
+        chat_rooms_blueprint.update_last_message(chat_room, user_1, delayed)
+        chat_room = ChatRoom.objects.get(id=chat_room.id)
+        self.assertEqual(chat_room.last_message.id, newest.id)
+        # nor the read pointer of the sender moves back.
+        self.assertEqual(
+            chat_room.last_read_message_ids[str(user_1.id)],
+            last_read_message_id)
+        
+        # only the members can post.
+        response = self.app.post(
+            "/chat_rooms/{room_id}/messages/intrusion".format(
+                room_id=chat_room.id), headers=dict(uid=outsider.uid))
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(ChatMessage.objects(chat_room=chat_room).count(), 200)
 
 
 if __name__ == "__main__":
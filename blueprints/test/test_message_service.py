@@ -0,0 +1,236 @@
+import firebase_admin
+import mock
+import queue
+import threading
+import time
+import unittest
+
+from mongoengine import connect, disconnect
+from blueprints.test.fcm_stub import FcmStub
+from blueprints.test.mock_data import *
+from model.models import User
+from shared import message_service
+
+from firebase_admin import exceptions
+from firebase_admin import messaging
+
+
+def send_all_succeeded(messages, app=None):
+    return messaging.BatchResponse([
+        messaging.SendResponse(dict(name="projects/pingme/messages/%d" % index), None)
+        for index, _ in enumerate(messages)
+    ])
+
+
+class MessageServiceTestCase(unittest.TestCase):
+    
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.fcm_stub = FcmStub().start()
+        cls.firebase_app = cls.fcm_stub.init_app()
+    
+    @classmethod
+    def tearDownClass(cls) -> None:
+        firebase_admin.delete_app(cls.firebase_app)
+        cls.fcm_stub.stop()
+    
+    def setUp(self) -> None:
+        connect("mongoenginetest", host="mongomock://localhost")
+    
+    def tearDown(self):
+        message_service.shutdown(timeout=5)
+        disconnect()
+    
+    @mock.patch.object(messaging, "send_all")
+    def test_push_returns_before_sending(self, send_all):
+        sending = threading.Event()
+        
+        def slow_send_all(messages, app=None):
+            sending.wait(timeout=5)
+            return send_all_succeeded(messages)
+        
+        send_all.side_effect = slow_send_all
+        
+        # push must not wait for the slow send.
+        future = message_service.dispatch(
+            dict(type="POKE"), mock_user_1["r_token"])
+        self.assertIsNotNone(future)
+        self.assertFalse(message_service.drain(timeout=0.1))
+        
+        sending.set()
+        self.assertTrue(message_service.drain(timeout=5))
+        self.assertEqual(future.result(timeout=5).success_count, 1)
+        self.assertEqual(
+            send_all.call_args[0][0][0].token, mock_user_1["r_token"])
+        self.assertEqual(message_service.get_stats()["queue_depth"], 0)
+    
+    @mock.patch.object(message_service, "STATS_INTERVAL", 0.05)
+    @mock.patch.object(messaging, "send_all")
+    def test_log_stats(self, send_all):
+        send_all.side_effect = send_all_succeeded
+        
+        with self.assertLogs("shared.message_service", "INFO") as logs:
+            message_service.dispatch(dict(type="POKE"), "token_stats")
+            self.assertTrue(message_service.drain(timeout=5))
+            deadline = time.monotonic() + 5
+            while not any("'sent'" in line for line in logs.output) and \
+                    time.monotonic() < deadline:
+                time.sleep(0.05)
+        
+        # a line of the counters, repeated only once they change.
+        self.assertIn("Push stats: ", logs.output[-1])
+        self.assertIn("'queue_depth': 0", logs.output[-1])
+        self.assertEqual(len(set(logs.output)), len(logs.output))
+    
+    @mock.patch.object(messaging, "send_all")
+    def test_push_without_token(self, send_all):
+        self.assertIsNone(message_service.dispatch(dict(type="POKE"), None))
+        self.assertIsNone(message_service.dispatch(dict(type="POKE"), [None, ""]))
+        self.assertTrue(message_service.drain(timeout=5))
+        self.assertEqual(send_all.call_count, 0)
+    
+    @mock.patch.object(messaging, "send_all")
+    def test_push_in_batches(self, send_all):
+        send_all.side_effect = send_all_succeeded
+        
+        futures = [
+            message_service.dispatch(
+                dict(type="POKE"), "token_{index}".format(index=index))
+            for index in range(1000)
+        ]
+        self.assertTrue(message_service.drain(timeout=10))
+        
+        # results are mapped back to each push.
+        for future in futures:
+            self.assertEqual(future.result(timeout=5).success_count, 1)
+        
+        sent = sum(len(call[0][0]) for call in send_all.call_args_list)
+        self.assertEqual(sent, 1000)
+        self.assertLess(send_all.call_count, 1000)
+        for call in send_all.call_args_list:
+            self.assertLessEqual(
+                len(call[0][0]), message_service.MAX_BATCH_SIZE)
+    
+    @mock.patch.object(messaging, "send_all")
+    def test_dispatch_multicast(self, send_all):
+        send_all.side_effect = send_all_succeeded
+        tokens = ["device_{0}".format(index) for index in range(3)]
+        
+        futures = [
+            message_service.dispatch(dict(type="POKE"), tokens + tokens[:1])
+            for _ in range(message_service.MAX_BATCH_SIZE // 2)
+        ]
+        self.assertTrue(message_service.drain(timeout=10))
+        
+        # a multicast is answered per token without duplicates, and is
+        # never split across the batches.
+        for future in futures:
+            response = future.result(timeout=5)
+            self.assertEqual(len(response.responses), len(tokens))
+            self.assertEqual(response.success_count, len(tokens))
+        for call in send_all.call_args_list:
+            messages = call[0][0]
+            self.assertLessEqual(len(messages), message_service.MAX_BATCH_SIZE)
+            self.assertEqual(len(messages) % len(tokens), 0)
+            self.assertEqual(
+                [message.token for message in messages[:len(tokens)]], tokens)
+    
+    @mock.patch.object(messaging, "send_all")
+    def test_dispatch_multicast_over_limit(self, send_all):
+        send_all.side_effect = send_all_succeeded
+        tokens = ["device_{0}".format(index) for index in range(1200)]
+        
+        future = message_service.dispatch(dict(type="POKE"), tokens)
+        self.assertTrue(message_service.drain(timeout=10))
+        
+        # every token is pushed, a multicast message per 500 of them.
+        response = future.result(timeout=5)
+        self.assertEqual(len(response.responses), len(tokens))
+        self.assertEqual(response.success_count, len(tokens))
+        sent = [message.token
+                for call in send_all.call_args_list for message in call[0][0]]
+        self.assertEqual(sorted(sent), sorted(tokens))
+        self.assertTrue(all(
+            len(call[0][0]) <= message_service.MAX_MULTICAST_TOKENS
+            for call in send_all.call_args_list))
+        
+        # a full queue fails the tokens of the groups dropped.
+        put_nowait = message_service._queue.put_nowait
+        
+        def put_first_group(item):
+            if item[0].tokens[0] != tokens[0]:
+                raise queue.Full()
+            put_nowait(item)
+        
+        with mock.patch.object(message_service._queue, "put_nowait",
+                               side_effect=put_first_group):
+            future = message_service.dispatch(dict(type="POKE"), tokens)
+        response = future.result(timeout=5)
+        self.assertEqual(len(response.responses), len(tokens))
+        self.assertEqual(response.failure_count, 700)
+        self.assertIsInstance(
+            response.responses[-1].exception, exceptions.UnavailableError)
+    
+    @mock.patch.object(messaging, "send_all")
+    def test_prune_dead_tokens(self, send_all):
+        def send_all_unregistered(messages, app=None):
+            return messaging.BatchResponse([
+                messaging.SendResponse(
+                    None, messaging.UnregisteredError("unregistered"))
+                if message.token == mock_user_1["r_token"] else
+                messaging.SendResponse(dict(name="projects/pingme/messages/0"), None)
+                for message in messages
+            ])
+        
+        send_all.side_effect = send_all_unregistered
+        User(uid=mock_user_1["uid"], r_token=mock_user_1["r_token"]).save()
+        User(uid=mock_user_3["uid"], r_token="alive_token").save()
+        
+        User(uid=mock_user_2["uid"], r_token="other_device_token",
+             r_tokens=["other_device_token", mock_user_1["r_token"]]).save()
+        
+        dead = message_service.dispatch(dict(type="POKE"), mock_user_1["r_token"])
+        alive = message_service.dispatch(dict(type="POKE"), "alive_token")
+        self.assertTrue(message_service.drain(timeout=5))
+        self.assertEqual(dead.result(timeout=5).failure_count, 1)
+        self.assertEqual(alive.result(timeout=5).success_count, 1)
+        
+        # the dead token is cleared and never pushed again.
+        self.assertIsNone(User.objects.get(uid=mock_user_1["uid"]).r_token)
+        self.assertEqual(
+            User.objects.get(uid=mock_user_2["uid"]).r_tokens,
+            ["other_device_token"])
+        self.assertEqual(
+            User.objects.get(uid=mock_user_3["uid"]).r_token, "alive_token")
+        self.assertIsNone(message_service.dispatch(
+            dict(type="POKE"), mock_user_1["r_token"]))
+        
+        message_service.discard_dead_token(mock_user_1["r_token"])
+    
+    def test_dispatch_to_fcm_stub(self):
+        self.fcm_stub.unregistered_tokens.add("unregistered_token")
+        User(uid=mock_user_1["uid"], r_token="unregistered_token").save()
+        
+        sent = message_service.dispatch(dict(type="POKE"), "alive_token")
+        dead = message_service.dispatch(dict(type="POKE"), "unregistered_token")
+        self.assertTrue(message_service.drain(timeout=10))
+        
+        self.assertEqual(sent.result(timeout=5).success_count, 1)
+        self.assertIsInstance(
+            dead.result(timeout=5).responses[0].exception,
+            messaging.UnregisteredError)
+        self.assertIsNone(User.objects.get(uid=mock_user_1["uid"]).r_token)
+        
+        message_service.discard_dead_token("unregistered_token")
+    
+    def test_fcm_stub_restores_endpoints(self):
+        service = messaging._MessagingService
+        urls = (service.FCM_URL, service.FCM_BATCH_URL)
+        
+        with FcmStub() as stub:
+            self.assertEqual(service.FCM_BATCH_URL, stub.url + "/batch")
+        self.assertEqual((service.FCM_URL, service.FCM_BATCH_URL), urls)
+
+
+if __name__ == "__main__":
+    unittest.main()
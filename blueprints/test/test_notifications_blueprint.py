@@ -1,13 +1,19 @@
 import firebase_admin
 import json
+import mock
+import pendulum
 import unittest
 
 from mongoengine import connect, disconnect
 from main import app
 from blueprints.test.mock_data import *
 from config import UnitTestConfig
-from model.models import User, Alert, AlertRecord
+from model.models import User, Alert, AlertRecord, LegacyAlertRecord, Post
 from shared.instances import init_firebase
+from blueprints import alerts_blueprint
+
+from firebase_admin import auth
+from firebase_admin import messaging
 
 
 class AlertsBlueprintTestCase(unittest.TestCase):
@@ -29,3 +35,249 @@ class AlertsBlueprintTestCase(unittest.TestCase):
     def tearDown(self):
         disconnect()
     
+    def create_user(self, user):
+        self.app.post("/users", data=json.dumps(user),
+                      headers=dict(uid=user["uid"]),
+                      content_type="application/json")
+        self.app.put("/users/profile", data=json.dumps(user),
+                     headers=dict(uid=user["uid"]),
+                     content_type="application/json")
+        return User.objects.get(uid=user["uid"])
+    
+    @mock.patch.object(auth, "verify_id_token")
+    @mock.patch.object(messaging, "send", return_value=None)
+    def test_list_alerts(self, send, verify_id_token):
+        verify_id_token.return_value = dict(uid=mock_user_1["uid"])
+        user_1 = self.create_user(mock_user_1)
+        verify_id_token.return_value = dict(uid=mock_user_2["uid"])
+        user_2 = self.create_user(mock_user_2)
+        verify_id_token.return_value = dict(uid=mock_user_3["uid"])
+        user_3 = self.create_user(mock_user_3)
+        
+        # user_1 and user_3 poke user_2
+        self.app.post("/users/poke/{user_id}".format(user_id=user_2.id),
+                      headers=dict(uid=user_1.uid))
+        self.app.post("/users/poke/{user_id}".format(user_id=user_2.id),
+                      headers=dict(uid=user_3.uid))
+        self.app.post("/users/poke/{user_id}".format(user_id=user_2.id),
+                      headers=dict(uid=user_1.uid))
+        
+        response = self.app.get("/alerts", headers=dict(uid=user_2.uid))
+        alerts = response.get_json()
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(alerts), 3)
+        for alert in alerts:
+            self.assertEqual(alert["type"], "POKE")
+            if alert["user_id"] == str(user_1.id):
+                self.assertEqual(alert["nick_name"], user_1.nick_name)
+                self.assertEqual(alert["image_url"], "")
+            else:
+                self.assertEqual(alert["user_id"], str(user_3.id))
+                self.assertEqual(alert["nick_name"], user_3.nick_name)
+    
+    @mock.patch.object(auth, "verify_id_token")
+    def test_create_alert(self, verify_id_token):
+        verify_id_token.return_value = dict(uid=mock_user_1["uid"])
+        user_1 = self.create_user(mock_user_1)
+        verify_id_token.return_value = dict(uid=mock_user_2["uid"])
+        user_2 = self.create_user(mock_user_2)
+        
+        for index in range(5):
+            alerts_blueprint.create_alert(
+                user_from=user_1, user_to=user_2, push_type="POKE",
+                message="poke {index}".format(index=index))
+        
+        records = AlertRecord.objects(owner=user_2).all()
+        self.assertEqual(len(records), 5)
+        self.assertEqual(AlertRecord.objects(owner=user_1).count(), 0)
+        self.assertEqual(Alert.objects.count(), 0)
+        
+        alerts_blueprint.enforce_alert_retention(user_2.id, keep=2)
+        self.assertEqual(AlertRecord.objects(owner=user_2).count(), 2)
+    
+    @mock.patch.object(auth, "verify_id_token")
+    def test_list_alerts_with_cursor(self, verify_id_token):
+        verify_id_token.return_value = dict(uid=mock_user_1["uid"])
+        user_1 = self.create_user(mock_user_1)
+        verify_id_token.return_value = dict(uid=mock_user_2["uid"])
+        user_2 = self.create_user(mock_user_2)
+        
+        for index in range(5):
+            alerts_blueprint.create_alert(
+                user_from=user_1, user_to=user_2, push_type="POKE",
+                message="poke {index}".format(index=index))
+        
+        response = self.app.get(
+            "/alerts?limit=3", headers=dict(uid=user_2.uid))
+        first_page = response.get_json()
+        self.assertEqual(len(first_page), 3)
+        self.assertEqual(
+            [alert["message"] for alert in first_page],
+            ["poke 4", "poke 3", "poke 2"])
+        
+        response = self.app.get(
+            "/alerts?limit=3&before={push_id}".format(
+                push_id=first_page[-1]["push_id"]),
+            headers=dict(uid=user_2.uid))
+        second_page = response.get_json()
+        self.assertEqual(
+            [alert["message"] for alert in second_page],
+            ["poke 1", "poke 0"])
+        
+        for query in ("limit=three", "before=invalid"):
+            response = self.app.get(
+                "/alerts?" + query, headers=dict(uid=user_2.uid))
+            self.assertEqual(response.status_code, 400)
+        
+        response = self.app.get(
+            "/alerts/unread_count", headers=dict(uid=user_2.uid))
+        self.assertEqual(response.get_json()["unread_count"], 5)
+    
+    @mock.patch.object(auth, "verify_id_token")
+    def test_update_all_alerts_as_read(self, verify_id_token):
+        verify_id_token.return_value = dict(uid=mock_user_1["uid"])
+        user_1 = self.create_user(mock_user_1)
+        verify_id_token.return_value = dict(uid=mock_user_2["uid"])
+        user_2 = self.create_user(mock_user_2)
+        
+        pendulum.set_test_now(pendulum.datetime(2020, 5, 21, 12))
+        alerts_blueprint.create_alert(
+            user_from=user_1, user_to=user_2, push_type="POKE")
+        pendulum.set_test_now(pendulum.datetime(2020, 5, 21, 13))
+        alerts_blueprint.create_alert(
+            user_from=user_1, user_to=user_2, push_type="POKE")
+        pendulum.set_test_now()
+        
+        response = self.app.put(
+            "/alerts?until=noon", headers=dict(uid=user_2.uid))
+        self.assertEqual(response.status_code, 400)
+        
+        # only the records created until the given time are read.
+        self.app.put("/alerts?until={until}".format(
+            until=pendulum.datetime(2020, 5, 21, 12).int_timestamp),
+            headers=dict(uid=user_2.uid))
+        response = self.app.get(
+            "/alerts/unread_count", headers=dict(uid=user_2.uid))
+        self.assertEqual(response.get_json()["unread_count"], 1)
+        
+        self.app.put("/alerts", headers=dict(uid=user_2.uid))
+        response = self.app.get(
+            "/alerts/unread_count", headers=dict(uid=user_2.uid))
+        self.assertEqual(response.get_json()["unread_count"], 0)
+    
+    @mock.patch.object(auth, "verify_id_token")
+    def test_create_alert_coalesced(self, verify_id_token):
+        verify_id_token.return_value = dict(uid=mock_user_1["uid"])
+        user_1 = self.create_user(mock_user_1)
+        verify_id_token.return_value = dict(uid=mock_user_2["uid"])
+        user_2 = self.create_user(mock_user_2)
+        verify_id_token.return_value = dict(uid=mock_user_3["uid"])
+        user_3 = self.create_user(mock_user_3)
+        post = Post(author=user_2, created_at=pendulum.now().int_timestamp).save()
+        
+        created_at = pendulum.datetime(2020, 5, 21, 12)
+        pendulum.set_test_now(created_at)
+        first = alerts_blueprint.create_alert(
+            user_from=user_1, user_to=user_2, push_type="FAVORITE", post=post)
+        pendulum.set_test_now(created_at.add(minutes=1))
+        second = alerts_blueprint.create_alert(
+            user_from=user_3, user_to=user_2, push_type="FAVORITE", post=post)
+        
+        self.assertEqual(first.count, 1)
+        self.assertEqual(second.id, first.id)
+        self.assertEqual(second.count, 2)
+        # the latest event brings the record to the top.
+        self.assertEqual(
+            second.created_at, created_at.add(minutes=1).int_timestamp)
+        self.assertEqual(AlertRecord.objects(owner=user_2).count(), 1)
+        
+        data = alerts_blueprint.dictify_push_item(second, user_3)
+        self.assertEqual(data["user_id"], str(user_3.id))
+        self.assertEqual(data["count"], "2")
+        self.assertEqual(
+            data["message"],
+            "{nick_name} 님 외 1명이 당신의 게시물을 좋아합니다.".format(
+                nick_name=user_3.nick_name))
+        
+        # a new record is created after the window of the latest event.
+        pendulum.set_test_now(created_at.add(minutes=1).add(
+            seconds=alerts_blueprint.COALESCE_WINDOW + 1))
+        third = alerts_blueprint.create_alert(
+            user_from=user_1, user_to=user_2, push_type="FAVORITE", post=post)
+        pendulum.set_test_now()
+        self.assertNotEqual(third.id, first.id)
+        self.assertEqual(third.count, 1)
+    
+    @mock.patch.object(auth, "verify_id_token")
+    def test_stream_alerts(self, verify_id_token):
+        verify_id_token.return_value = dict(uid=mock_user_1["uid"])
+        user_1 = self.create_user(mock_user_1)
+        verify_id_token.return_value = dict(uid=mock_user_2["uid"])
+        user_2 = self.create_user(mock_user_2)
+        
+        alerts_blueprint.create_alert(
+            user_from=user_1, user_to=user_2,
+            push_type="POKE", message="poke 0")
+        
+        response = self.app.get(
+            "/alerts/stream?since=0", headers=dict(uid=user_2.uid))
+        stream = iter(response.response)
+        
+        # the alerts created since the given time come first.
+        event = next(stream)
+        self.assertIn("poke 0", event.decode() if isinstance(event, bytes) else event)
+        
+        # then the alerts created while the stream is open.
+        alerts_blueprint.create_alert(
+            user_from=user_1, user_to=user_2,
+            push_type="POKE", message="poke 1")
+        event = next(stream)
+        self.assertIn("poke 1", event.decode() if isinstance(event, bytes) else event)
+        
+        response.close()
+        
+        response = self.app.get(
+            "/alerts/stream?since=yesterday", headers=dict(uid=user_2.uid))
+        self.assertEqual(response.status_code, 400)
+    
+    def test_migrate_legacy_alerts(self):
+        user_1 = User(uid=mock_user_1["uid"], nick_name="user_1").save()
+        user_2 = User(uid=mock_user_2["uid"], nick_name="user_2").save()
+        
+        # more embedded records than kept, the latest last.
+        count = alerts_blueprint.MAX_ALERT_RECORDS + 5
+        legacy = Alert(owner=user_1, records=[
+            LegacyAlertRecord(
+                push_type="POKE", user_id=user_2.id,
+                message="poke_{0}".format(index), created_at=index,
+                is_read=index % 2 == 0)
+            for index in range(count)
+        ]).save()
+        raw = Alert.objects(id=legacy.id).as_pymongo().first()
+        
+        alerts_blueprint.start_legacy_alerts_migration().join(timeout=10)
+        # a run stopped before deleting the legacy alert is run again.
+        Alert._get_collection().insert_one(raw)
+        alerts_blueprint.migrate_legacy_alerts()
+        
+        self.assertEqual(Alert.objects.count(), 0)
+        records = AlertRecord.objects(owner=user_1).order_by("-created_at")
+        self.assertEqual(records.count(), alerts_blueprint.MAX_ALERT_RECORDS)
+        self.assertEqual(
+            [record.message for record in records[:2]],
+            ["poke_{0}".format(count - 1), "poke_{0}".format(count - 2)])
+        self.assertEqual(
+            records[0].id, raw["records"][0]["id"])
+        self.assertEqual(
+            records.filter(is_read=False).count(),
+            alerts_blueprint.MAX_ALERT_RECORDS // 2)
+        
+        # the moved records are listed like the new ones.
+        response = self.app.get("/alerts", headers=dict(uid=user_1.uid))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response.get_json()[0]["message"], "poke_{0}".format(count - 1))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,15 +1,19 @@
+import base64
 import firebase_admin
 import json
 import io
 import os
 import mock
+import mongomock
 import unittest
 
 from mongoengine import connect, disconnect
 from main import app
 from blueprints.test.mock_data import *
 from config import UnitTestConfig
-from model.models import Post, Comment, User
+from blueprints import posts_blueprint
+from model.models import Post, Comment, User, AlertRecord
+from shared import message_service
 from shared.instances import init_firebase
 
 from firebase_admin import auth
@@ -136,7 +140,7 @@ class PostsBlueprintTestCase(unittest.TestCase):
     @mock.patch.object(auth, 'verify_id_token', return_value=dict(uid=mock_user_1["uid"]))
     @mock.patch.object(messaging, 'send', return_value=None)
     def test_route_list_posts_with_favorite(self, send, verify_id_token):
-        """Checks if the response includes favorite_user_ids but not favorite_users."""
+        """Checks if the response tells the user favorited the post."""
         # insert user then create post
         self.ping_to_create_post(
             user=mock_user_1, title="mock_title_1",
@@ -148,11 +152,201 @@ class PostsBlueprintTestCase(unittest.TestCase):
         self.app.post("/posts/{pid}/favorite".format(
             pid=post.id), headers=dict(uid=mock_user_1["uid"]))
         
-        response = self.app.get("/posts?page=0")
+        response = self.app.get(
+            "/posts?page=0", headers=dict(uid=mock_user_1["uid"]))
         posts = response.get_json()
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(posts[0]["favorite_user_ids"]), 1)
+        self.assertTrue(posts[0]["favorited"])
         self.assertEqual(len(posts[0]["favorite_users"]), 0)
+        self.assertEqual(posts[0]["favorite_count"], 1)
+    
+    def test_route_list_posts_by_cursor(self):
+        """Checks to page through the posts by the cursor."""
+        user = User(uid=mock_user_1["uid"], nick_name="user_1").save()
+        for index in range(25):
+            # two posts in a second, the id breaks the ties.
+            Post(author=user, title="post_{0}".format(index),
+                 created_at=1600000000 + index // 2).save()
+        
+        pages, cursor = [], None
+        while True:
+            response = self.app.get("/posts", query_string=dict(
+                per_page=10, **(dict(cursor=cursor) if cursor else {})))
+            self.assertEqual(response.status_code, 200)
+            pages.append([post["title"] for post in response.get_json()])
+            cursor = response.headers.get("X-Next-Cursor")
+            if not cursor:
+                break
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual(
+            sum(pages, []),
+            ["post_{0}".format(index) for index in reversed(range(25))])
+        
+        # a page of the same size at any depth by the page number.
+        response = self.app.get("/posts?page=1&per_page=10")
+        self.assertEqual(
+            [post["title"] for post in response.get_json()],
+            ["post_{0}".format(index) for index in reversed(range(5, 15))])
+        
+        # malformed parameters are rejected.
+        for query in ("cursor=invalid", "cursor=" + base64.urlsafe_b64encode(
+                b"yesterday:post").decode(), "page=first", "per_page=ten"):
+            response = self.app.get("/posts?" + query)
+            self.assertEqual(response.status_code, 400)
+    
+    def test_route_list_posts_with_comments(self):
+        """Checks the comments and their users in the posts without tokens."""
+        user_1 = User(uid=mock_user_1["uid"], nick_name="user_1",
+                      r_token="token_1", r_tokens=["token_1"]).save()
+        user_2 = User(uid=mock_user_2["uid"], nick_name="user_2").save()
+        sub_comment = Comment(user=user_1, comment="sub_comment",
+                              created_at=3).save()
+        comment_1 = Comment(user=user_2, comment="comment_1",
+                            sub_comments=[sub_comment], created_at=1).save()
+        comment_2 = Comment(user=user_1, comment="comment_2",
+                            created_at=2).save()
+        post = Post(author=user_1, title="post", created_at=1600000000,
+                    comments=[comment_1, comment_2],
+                    favorite_users=[user_2],
+                    favorite_user_ids=[user_2.id]).save()
+        
+        headers = dict(uid=user_2.uid)
+        for response in (
+                self.app.get("/posts", headers=headers),
+                self.app.get("/posts/{0}".format(post.id), headers=headers)):
+            self.assertEqual(response.status_code, 200)
+            body = response.get_json()
+            result = body[0] if isinstance(body, list) else body
+            
+            self.assertEqual(result["id"], str(post.id))
+            self.assertEqual(result["author"]["nick_name"], "user_1")
+            self.assertNotIn("r_token", result["author"])
+            self.assertNotIn("r_tokens", result["author"])
+            # favorite_user_ids is kept next to favorited until deprecated.
+            self.assertTrue(result["favorited"])
+            self.assertEqual(result["favorite_user_ids"], [str(user_2.id)])
+            
+            # the users are only in place of a single post.
+            favorite_users = result["favorite_users"]
+            if isinstance(body, list):
+                self.assertEqual(favorite_users, [])
+            else:
+                self.assertEqual(
+                    [user["nick_name"] for user in favorite_users], ["user_2"])
+                self.assertNotIn("r_token", favorite_users[0])
+            
+            # the latest comment first.
+            comments = result["comments"]
+            self.assertEqual(
+                [comment["comment"] for comment in comments],
+                ["comment_2", "comment_1"])
+            self.assertEqual(comments[1]["user"]["uid"], mock_user_2["uid"])
+            self.assertEqual(
+                comments[1]["sub_comments"][0]["user"]["nick_name"], "user_1")
+            self.assertEqual(comments[0]["sub_comments"], [])
+        
+        response = self.app.get("/posts/invalid")
+        self.assertEqual(response.status_code, 404)
+    
+    def test_route_list_posts_queries(self):
+        """Checks a page of posts is read by 4 queries at any size."""
+        users = [User(uid="user_{0}".format(index)).save()
+                 for index in range(6)]
+        for index, user in enumerate(users):
+            comments = []
+            for other in users:
+                sub_comment = Comment(user=user, comment="sub_comment",
+                                      created_at=index).save()
+                comments.append(Comment(
+                    user=other, comment="comment", created_at=index,
+                    sub_comments=[sub_comment]).save())
+            Post(author=user, title="post_{0}".format(index),
+                 comments=comments, created_at=index).save()
+        
+        find = mongomock.collection.Collection.find
+        
+        def count_queries(per_page):
+            with mock.patch.object(
+                    mongomock.collection.Collection, "find",
+                    autospec=True, side_effect=find) as counted:
+                response = self.app.get(
+                    "/posts", query_string=dict(per_page=per_page))
+            self.assertEqual(len(response.get_json()), per_page)
+            return counted.call_count
+        
+        # the posts, the comments, the sub comments then their users.
+        self.assertEqual(count_queries(1), 4)
+        self.assertEqual(count_queries(6), 4)
+    
+    @mock.patch.object(message_service, "push")
+    def test_post_counters(self, push):
+        """Checks the counters change only when the users or comments do."""
+        user_1 = User(uid=mock_user_1["uid"], nick_name="user_1").save()
+        user_2 = User(uid=mock_user_2["uid"], nick_name="user_2").save()
+        post = Post(author=user_1, title="post",
+                    created_at=1600000000).save()
+        
+        def favorite(method, user):
+            response = getattr(self.app, method)(
+                "/posts/{0}/favorite".format(post.id),
+                headers=dict(uid=user.uid))
+            self.assertEqual(response.status_code, 200)
+            return Post.objects.get(id=post.id).favorite_count
+        
+        self.assertEqual(favorite("post", user_1), 1)
+        self.assertEqual(favorite("post", user_1), 1)
+        self.assertEqual(favorite("post", user_2), 2)
+        
+        # a repeated favorite is not alerted again.
+        alert = AlertRecord.objects.get(owner=user_1, post_id=post.id)
+        self.assertEqual(alert.count, 2)
+        self.assertEqual(push.call_count, 1)
+        self.assertEqual(favorite("delete", user_1), 1)
+        self.assertEqual(favorite("delete", user_1), 1)
+        
+        # the feed tells whether the user favorited the post.
+        for user, favorited in ((user_1, False), (user_2, True), (None, False)):
+            response = self.app.get(
+                "/posts", headers=dict(uid=user.uid) if user else {})
+            result = response.get_json()[0]
+            self.assertIs(result["favorited"], favorited)
+            self.assertEqual(result["favorite_user_ids"], [str(user_2.id)])
+            self.assertEqual(result["favorite_count"], 1)
+        
+        response = self.app.post(
+            "/posts/{0}/comment".format(post.id),
+            headers=dict(uid=user_1.uid), data=dict(comment="comment"))
+        self.assertEqual(response.status_code, 200)
+        self.app.post(
+            "/posts/{0}/comment".format(post.id),
+            headers=dict(uid=user_2.uid),
+            data=dict(comment="sub_comment",
+                      comment_id=response.get_json()["id"]))
+        self.assertEqual(Post.objects.get(id=post.id).comment_count, 2)
+    
+    def test_backfill_post_counters(self):
+        user_1 = User(uid=mock_user_1["uid"], nick_name="user_1").save()
+        user_2 = User(uid=mock_user_2["uid"], nick_name="user_2").save()
+        sub_comment = Comment(user=user_2, comment="sub_comment",
+                              created_at=2).save()
+        comment = Comment(user=user_1, comment="comment",
+                          sub_comments=[sub_comment], created_at=1).save()
+        post_1 = Post(author=user_1, created_at=1,
+                      favorite_users=[user_1, user_2],
+                      favorite_user_ids=[user_1.id, user_2.id],
+                      comments=[comment]).save()
+        post_2 = Post(author=user_2, created_at=2).save()
+        Post.objects.update(unset__favorite_count=True,
+                            unset__comment_count=True)
+        
+        posts_blueprint.backfill_post_counters(batch_size=1)
+        
+        post_1, post_2 = Post.objects.get(id=post_1.id), \
+            Post.objects.get(id=post_2.id)
+        self.assertEqual(
+            (post_1.favorite_count, post_1.comment_count), (2, 2))
+        self.assertEqual(
+            (post_2.favorite_count, post_2.comment_count), (0, 0))
     
     @mock.patch.object(auth, 'verify_id_token')
     @mock.patch.object(messaging, 'send', return_value=None)
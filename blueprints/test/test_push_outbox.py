@@ -0,0 +1,145 @@
+import mock
+import pendulum
+import queue
+import unittest
+
+from concurrent.futures import Future
+from mongoengine import connect, disconnect
+from blueprints.test.mock_data import *
+from model.models import PushJob, DeadPushJob
+from shared import message_service
+from shared import push_outbox
+
+from firebase_admin import exceptions
+from firebase_admin import messaging
+
+
+class FakeFcm(object):
+    """Stand-in of FCM answering every message with the given error,
+       or the tokens in `exceptions` with their errors.
+    """
+    
+    def __init__(self, exception=None, exceptions=None):
+        self.exception = exception
+        self.exceptions = exceptions or {}
+        self.sent = []
+    
+    def dispatch(self, data=None, tokens=None) -> Future:
+        responses = []
+        for token in tokens:
+            self.sent.append((data, token))
+            exception = self.exceptions.get(token, self.exception)
+            if exception:
+                responses.append(messaging.SendResponse(None, exception))
+            else:
+                responses.append(messaging.SendResponse(dict(
+                    name="projects/pingme/messages/%d" % len(self.sent)), None))
+        future = Future()
+        future.set_result(messaging.BatchResponse(responses))
+        return future
+
+
+class PushOutboxTestCase(unittest.TestCase):
+    
+    def setUp(self) -> None:
+        connect("mongoenginetest", host="mongomock://localhost")
+        pendulum.set_test_now(pendulum.datetime(2020, 5, 21, 12))
+    
+    def tearDown(self):
+        pendulum.set_test_now()
+        disconnect()
+    
+    def test_push_many(self):
+        jobs = message_service.push_many([
+            (dict(type="POKE"), [mock_user_1["r_token"]]),
+            (dict(type="POKE"), []),
+            (dict(type="POKE"), [mock_user_2["r_token"], "other_device_token"])
+        ])
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(PushJob.objects.count(), 2)
+        self.assertEqual(
+            jobs[1].tokens, [mock_user_2["r_token"], "other_device_token"])
+    
+    def test_process_outbox(self):
+        fcm = FakeFcm()
+        message_service.push(dict(type="POKE"), [mock_user_1["r_token"]])
+        message_service.push(
+            dict(type="POKE"), [mock_user_2["r_token"], "other_device_token"])
+        
+        self.assertEqual(push_outbox.process_outbox(fcm.dispatch), 2)
+        self.assertEqual(len(fcm.sent), 3)
+        self.assertEqual(PushJob.objects.count(), 0)
+        self.assertEqual(push_outbox.process_outbox(fcm.dispatch), 0)
+    
+    def test_process_outbox_with_retry(self):
+        fcm = FakeFcm(exceptions.UnavailableError("unavailable"))
+        message_service.push(dict(type="POKE"), [mock_user_1["r_token"]])
+        
+        for attempts in range(1, push_outbox.MAX_ATTEMPTS):
+            self.assertEqual(push_outbox.process_outbox(fcm.dispatch), 1)
+            job = PushJob.objects.first()
+            self.assertEqual(job.attempts, attempts)
+            self.assertGreater(
+                job.next_attempt_at, pendulum.now().int_timestamp)
+            
+            # not retried until the backoff is over.
+            self.assertEqual(push_outbox.process_outbox(fcm.dispatch), 0)
+            pendulum.set_test_now(pendulum.now().add(
+                seconds=push_outbox.MAX_BACKOFF))
+        
+        # the last failure moves the job to the dead letters.
+        self.assertEqual(push_outbox.process_outbox(fcm.dispatch), 1)
+        self.assertEqual(PushJob.objects.count(), 0)
+        dead_job = DeadPushJob.objects.first()
+        self.assertEqual(dead_job.tokens, [mock_user_1["r_token"]])
+        self.assertEqual(dead_job.attempts, push_outbox.MAX_ATTEMPTS)
+        self.assertEqual(len(fcm.sent), push_outbox.MAX_ATTEMPTS)
+    
+    def test_process_outbox_with_failed_device(self):
+        fcm = FakeFcm(exceptions={
+            "failed_device_token": exceptions.UnavailableError("unavailable"),
+            "dead_device_token": messaging.UnregisteredError("unregistered")})
+        message_service.push(dict(type="POKE"), [
+            mock_user_1["r_token"], "failed_device_token", "dead_device_token"])
+        
+        # only the device failed for a while is retried.
+        self.assertEqual(push_outbox.process_outbox(fcm.dispatch), 1)
+        self.assertEqual(PushJob.objects.first().tokens, ["failed_device_token"])
+        
+        pendulum.set_test_now(pendulum.now().add(seconds=push_outbox.MAX_BACKOFF))
+        fcm.exceptions.clear()
+        self.assertEqual(push_outbox.process_outbox(fcm.dispatch), 1)
+        self.assertEqual(fcm.sent[-1][1], "failed_device_token")
+        self.assertEqual(PushJob.objects.count(), 0)
+    
+    def test_process_outbox_with_dead_token(self):
+        fcm = FakeFcm(messaging.UnregisteredError("unregistered"))
+        message_service.push(dict(type="POKE"), [mock_user_1["r_token"]])
+        
+        self.assertEqual(push_outbox.process_outbox(fcm.dispatch), 1)
+        self.assertEqual(PushJob.objects.count(), 0)
+        self.assertEqual(DeadPushJob.objects.count(), 0)
+    
+    
+    @mock.patch.object(message_service, "start_workers")
+    def test_process_outbox_with_full_queue(self, start_workers):
+        full_queue = queue.Queue(maxsize=1)
+        full_queue.put_nowait(None)
+        message_service.push(dict(type="POKE"), [
+            "device_{0}".format(index)
+            for index in range(message_service.MAX_MULTICAST_TOKENS + 1)])
+        dropped = message_service.get_stats()["dropped"]
+        
+        # the push dropped by the dispatcher is kept to be retried.
+        with mock.patch.object(message_service, "_queue", full_queue):
+            self.assertEqual(push_outbox.process_outbox(), 1)
+        job = PushJob.objects.get()
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(len(job.tokens), message_service.MAX_MULTICAST_TOKENS + 1)
+        self.assertGreater(job.next_attempt_at, pendulum.now().int_timestamp)
+        self.assertIn("full", job.last_error)
+        self.assertEqual(
+            message_service.get_stats()["dropped"] - dropped, len(job.tokens))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -10,6 +10,7 @@ from firebase_admin import messaging
 from main import app
 from model.models import User, Request, ChatRoom
 from mongoengine import connect, disconnect
+from shared import message_service
 from shared.instances import init_firebase
 from unittest import mock
 from werkzeug import exceptions
@@ -49,7 +50,7 @@ class RequestsBlueprintTestCase(unittest.TestCase):
         return uid_from, uid_to
     
     @mock.patch.object(auth, 'verify_id_token')
-    @mock.patch.object(messaging, 'send', return_value=None)
+    @mock.patch.object(message_service, 'push', return_value=None)
     def test_create_request(self, mock_send, mock_verify_id_token):
         """Should have a new request has been created."""
         
@@ -90,7 +91,7 @@ class RequestsBlueprintTestCase(unittest.TestCase):
         self.assertEqual(mock_send.call_count, 1)
     
     @mock.patch.object(auth, 'verify_id_token')
-    @mock.patch.object(messaging, 'send', return_value=None)
+    @mock.patch.object(message_service, 'push', return_value=None)
     def test_create_duplicated_request(
             self, mock_send, mock_verify_id_token):
         """Should have a bad request exception raise."""
@@ -136,7 +137,7 @@ class RequestsBlueprintTestCase(unittest.TestCase):
             self.assertEqual(mock_send.call_count, 1)
     
     @mock.patch.object(auth, 'verify_id_token')
-    @mock.patch.object(messaging, 'send', return_value=None)
+    @mock.patch.object(message_service, 'push', return_value=None)
     def test_create_request_when_he_already_sent_me(
             self, mock_send, mock_verify_id_token):
         """Should have the response of the request become 1."""
@@ -186,7 +187,7 @@ class RequestsBlueprintTestCase(unittest.TestCase):
         self.assertEqual(request.response, 1)
     
     @mock.patch.object(auth, 'verify_id_token')
-    @mock.patch.object(messaging, 'send', return_value=None)
+    @mock.patch.object(message_service, 'push', return_value=None)
     def test_list_requests_to_me(self, mock_send, mock_verify_id_token):
         """Should have requests list which does like me."""
         
@@ -254,7 +255,7 @@ class RequestsBlueprintTestCase(unittest.TestCase):
         self.assertEqual(request_2.user_to.uid, mock_user_1["uid"])  # user_to
     
     @mock.patch.object(auth, 'verify_id_token')
-    @mock.patch.object(messaging, 'send', return_value=None)
+    @mock.patch.object(message_service, 'push', return_value=None)
     def test_update_request_accepted(self, mock_send, mock_verify_id_token):
         """Should have response become 1 after the update."""
         # set mock time
@@ -315,7 +316,7 @@ class RequestsBlueprintTestCase(unittest.TestCase):
         self.assertEqual(chat_room.created_at, pendulum.now().int_timestamp)
     
     @mock.patch.object(auth, 'verify_id_token')
-    @mock.patch.object(messaging, 'send', return_value=None)
+    @mock.patch.object(message_service, 'push', return_value=None)
     def test_update_request_declined(self, mock_send, mock_verify_id_token):
         """Should have response become 0 after the update."""
         # set mock time
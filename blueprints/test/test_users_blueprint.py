@@ -12,6 +12,7 @@ from blueprints.test.mock_data import *
 from blueprints import users_blueprint
 from config import UnitTestConfig
 from model.models import User, ChatRoom, StarRating
+from shared import message_service
 from shared.instances import init_firebase
 
 from firebase_admin import auth
@@ -452,6 +453,20 @@ class UsersBlueprintTestCase(unittest.TestCase):
         user_1 = User.objects(uid=mock_user_1["uid"]).first()
         # registration_token must be updated.
         self.assertEqual(user_1.r_token, "updated_registration_token_value")
+        self.assertEqual(user_1.r_tokens, ["updated_registration_token_value"])
+        
+        # the newest token comes first, the oldest are evicted.
+        for index in range(users_blueprint.MAX_REGISTRATION_TOKENS + 1):
+            self.app.put("/users/r_token/device_{0}".format(index),
+                         headers=dict(uid=mock_user_1["uid"]))
+        self.app.put("/users/r_token/device_3",
+                     headers=dict(uid=mock_user_1["uid"]))
+        
+        user_1.reload()
+        self.assertEqual(user_1.r_token, "device_3")
+        self.assertEqual(
+            user_1.r_tokens,
+            ["device_3", "device_5", "device_4", "device_2", "device_1"])
     
     @mock.patch.object(auth, 'verify_id_token')
     @mock.patch.object(messaging, 'send', return_value=None)
@@ -494,14 +509,12 @@ class UsersBlueprintTestCase(unittest.TestCase):
             title=None,
             members=[user_1, user_2],
             members_history=[user_1, user_2],
-            messages=[],
             created_at=pendulum.now().int_timestamp
         ).save()
         chat_room_2 = ChatRoom(
             title=None,
             members=[user_2, user_3],
             members_history=[user_2, user_3],
-            messages=[],
             created_at=pendulum.now().int_timestamp
         ).save()
         
@@ -534,12 +547,9 @@ class UsersBlueprintTestCase(unittest.TestCase):
         self.assertEqual(room_2_members[0]["uid"], mock_user_2["uid"])
         self.assertEqual(room_2_members[1]["uid"], mock_user_3["uid"])
         
-        # messages validation
-        room_1_messages, room_2_messages = room_1["messages"], room_2["messages"]
-        self.assertEqual(room_1_messages[0]["message"], "test_message_1")
-        self.assertEqual(room_1_messages[1]["message"], "test_message_2")
-        self.assertEqual(room_1_messages[2]["message"], "test_message_3")
-        self.assertEqual(len(room_2_messages), 0)
+        # messages are never shipped with the list.
+        self.assertNotIn("messages", room_1)
+        self.assertNotIn("messages", room_2)
     
     @mock.patch.object(auth, 'verify_id_token', return_value=dict(uid=mock_user_1["uid"]))
     def test_list_user_posts(self, verify_id_token):
@@ -589,7 +599,7 @@ class UsersBlueprintTestCase(unittest.TestCase):
             posts[0]["url"], "https://storage.googleapis.com/.*")
     
     @mock.patch.object(auth, 'verify_id_token')
-    @mock.patch.object(messaging, 'send', return_value=None)
+    @mock.patch.object(message_service, 'push', return_value=None)
     def test_poke(self, mock_send, verify_id_token):
         # insert user_1
         verify_id_token.return_value = dict(uid=mock_user_1["uid"])
@@ -16,12 +16,12 @@ from flask import Blueprint
 from flask import request
 from flask import Response
 
-from firebase_admin import messaging
 from firebase_admin import storage
 from firebase_admin import auth
 
-from model.models import User, UserImage, ChatRoom, Alert, Request, StarRating
+from model.models import User, UserImage, ChatRoom, Request, StarRating
 from shared import message_service
+from shared.utils import get_registration_tokens
 
 users_blueprint = Blueprint("users_blueprint", __name__)
 
@@ -34,6 +34,8 @@ PENDING = 10
 APPROVED = 20
 REJECTED = -10
 
+MAX_REGISTRATION_TOKENS = 5  # devices a user receives pushes on
+
 http = urllib3.PoolManager()
 
 ACCESS_KEY = "e8ab27ee174997778b7826a94b7db233"
@@ -67,7 +69,6 @@ def create_user():
     if not user:
         user = User(
             uid=uid, status=OPENED, available=False).save()
-        Alert(owner=user, records=[]).save()
     
     return Response(
         user.to_json(),
@@ -119,7 +120,8 @@ def update_user_profile():
         "star_ratings_i_rated",
         "user_images",
         "location",
-        "r_token"
+        "r_token",
+        "r_tokens"
     ]
     for p in prohibited:
         user_json.pop(p, None)
@@ -219,11 +221,25 @@ def get_session():
 @users_blueprint.route(
     "/users/r_token/<r_token>", methods=["PUT"])
 def route_update_registration_token(r_token: str):
-    """Endpoint for updating user registration token."""
+    """Endpoint for updating user registration token.
+       The token moves to the head of r_tokens, the oldest are evicted.
+    """
     uid = request.headers.get("uid", None)
     user = User.objects.get_or_404(uid=uid)
-    user.r_token = r_token
-    user.save()
+    
+    # $addToSet can't $slice, so the token is pulled then pushed at the head.
+    User.objects(id=user.id).update(pull__r_tokens=r_token)
+    User.objects(id=user.id).update(
+        __raw__={
+            "$set": {"r_token": r_token},
+            "$push": {"r_tokens": {
+                "$each": [r_token],
+                "$position": 0,
+                "$slice": MAX_REGISTRATION_TOKENS
+            }}
+        })
+    message_service.discard_dead_token(r_token)
+    user.reload()
     
     return Response(
         user.to_json(),
@@ -371,22 +387,12 @@ def route_poke(user_id_to):
     
     user_to = User.objects(id=user_id_to).get_or_404()
     
-    alert = alerts_blueprint.create_alert(
+    push_item = alerts_blueprint.create_alert(
         user_from, user_to, push_type="POKE",
         message="{nick_name} 님이 당신을 찔렀습니다.".format(
             nick_name=user_from.nick_name))
-    push_item = alert.records[-1]
-    data: dict = alerts_blueprint.dictify_push_item(push_item)
-    
-    try:
-        message = messaging.Message(
-            data=data, token=user_to.r_token,
-            apns=messaging.APNSConfig(),
-            android=messaging.AndroidConfig(priority="high"),
-            notification=messaging.Notification())
-        messaging.send(message)
-    except Exception as e:
-        logging.exception(e)
+    data: dict = alerts_blueprint.dictify_push_item(push_item, user_from)
+    message_service.push(data, get_registration_tokens(user_to))
     
     return Response(
         user_to.to_json(),
@@ -467,14 +473,13 @@ def route_update_star_rating(user_id: str, score: int):
             score=score
         ).save()
         if score > 3:
-            alert = alerts_blueprint.create_alert(
+            push_item = alerts_blueprint.create_alert(
                 user_from=user_from, user_to=user_to,
                 push_type="STAR_RATING",
                 message="{nick_name} 님이 당신을 높게 평가 하였습니다.".format(
                     nick_name=user_from.nick_name))
-            push_item = alert.records[-1]
-            data = alerts_blueprint.dictify_push_item(push_item)
-            message_service.push(data, user_to.r_token)
+            data = alerts_blueprint.dictify_push_item(push_item, user_from)
+            message_service.push(data, get_registration_tokens(user_to))
     
     return Response("", mimetype="application/json")
 
@@ -17,14 +17,19 @@ log_path = os.path.join(
     Path(os.path.dirname(
         os.path.abspath(__file__))), 'flask_instance.log')
 
-app.logger.addHandler(
-    logging.handlers.RotatingFileHandler(
-        filename=log_path, mode='a',
-        maxBytes=10485760, backupCount=5,
-        encoding='utf-8', delay=False))
+log_handler = logging.handlers.RotatingFileHandler(
+    filename=log_path, mode='a',
+    maxBytes=10485760, backupCount=5,
+    encoding='utf-8', delay=False)
+
+app.logger.addHandler(log_handler)
 
 app.logger.setLevel(logging.DEBUG)
 
+# the background services log their stats to the same file.
+logging.getLogger("shared").addHandler(log_handler)
+logging.getLogger("shared").setLevel(logging.INFO)
+
 app.register_blueprint(users_blueprint)
 app.register_blueprint(posts_blueprint)
 app.register_blueprint(requests_blueprint)
@@ -35,7 +35,8 @@ class User(gj.Document):
     drink_id = db.IntField()
     smoking_id = db.IntField()
     blood_id = db.IntField()
-    r_token = db.StringField()
+    r_token = db.StringField()  # the latest of r_tokens
+    r_tokens = db.ListField(db.StringField())  # newest first
     location = db.PointField()
     introduction = db.StringField()
     joined_at = db.LongField()
@@ -103,7 +104,8 @@ class Comment(gj.Document):
 
 class Post(gj.Document):
     meta = {
-        'queryset_class': fm.BaseQuerySet
+        'queryset_class': fm.BaseQuerySet,
+        'indexes': [('-created_at', '-id')]
     }
     author = db.ReferenceField(
         User, required=True, reverse_delete_rule=db.CASCADE)
@@ -117,6 +119,8 @@ class Post(gj.Document):
     comments = db.ListField(
         db.ReferenceField(
             Comment, reverse_delete_rule=db.CASCADE))
+    favorite_count = db.LongField(default=0)  # of favorite_user_ids
+    comment_count = db.LongField(default=0)  # of comments and sub comments
     created_at = db.LongField(required=True)
     enable_comment = db.BooleanField()
     is_deleted = db.BooleanField()
@@ -148,12 +152,9 @@ class StarRating(gj.Document):
     score = db.IntField(required=True)
 
 
-class Message(gj.EmbeddedDocument):
-    meta = {
-        'queryset_class': fm.BaseQuerySet
-    }
-    id = db.ObjectIdField(
-        required=True, default=lambda: ObjectId())
+class MessagePreview(gj.EmbeddedDocument):
+    """The latest message of a chat room, shown in the room list."""
+    id = db.ObjectIdField(required=True)
     user_id = db.ObjectIdField()
     message = db.StringField()
     created_at = db.LongField(required=True)
@@ -161,20 +162,69 @@ class Message(gj.EmbeddedDocument):
 
 class ChatRoom(gj.Document):
     meta = {
-        'queryset_class': fm.BaseQuerySet
+        'queryset_class': fm.BaseQuerySet,
+        'strict': False,  # rooms not migrated yet still embed messages.
+        'indexes': ['members']
     }
     title = db.StringField(max_length=500)
     members = db.SortedListField(
         db.ReferenceField(User), reverse_delete_rule=db.CASCADE)
     members_history = db.ListField(
         db.ReferenceField(User), reverse_delete_rule=db.CASCADE)
-    messages = db.EmbeddedDocumentListField(Message)
+    last_message = db.EmbeddedDocumentField(MessagePreview)
+    # the last message read by each member, keyed by the user id.
+    last_read_message_ids = db.MapField(db.ObjectIdField())
+    # created_at of the newest message moved to the archive.
+    archived_until = db.LongField()
     created_at = db.LongField(required=True)
     available = db.BooleanField(required=True, default=False)
     available_at = db.LongField()
 
 
-class AlertRecord(gj.EmbeddedDocument):
+class ChatMessage(gj.Document):
+    meta = {
+        'queryset_class': fm.BaseQuerySet,
+        'indexes': [
+            ('chat_room', '-created_at', '-id'),
+            # the unread messages are a range after the last read id.
+            ('chat_room', 'id'),
+            # scoped to (chat_room, user_id) by get_client_id.
+            {'fields': ['client_id'], 'unique': True, 'sparse': True}
+        ]
+    }
+    chat_room = db.ReferenceField(
+        ChatRoom, required=True, reverse_delete_rule=db.CASCADE)
+    user_id = db.ObjectIdField()
+    message = db.StringField()
+    client_id = db.StringField()  # idempotency key of the bulk posts per room and user
+    created_at = db.LongField(required=True)
+
+
+class AlertRecord(gj.Document):
+    meta = {
+        'queryset_class': fm.BaseQuerySet,
+        'indexes': [
+            ('owner', '-created_at', '-id'),
+            ('owner', 'is_read')
+        ]
+    }
+    owner = db.ReferenceField(
+        User, reverse_delete_rule=db.CASCADE)
+    push_type = db.StringField(
+        required=True)
+    user_id = db.ObjectIdField()
+    post_id = db.ObjectIdField()
+    comment_id = db.ObjectIdField()
+    request_id = db.ObjectIdField()
+    chat_room_id = db.ObjectIdField()
+    message_id = db.ObjectIdField()  # ChatMessage
+    message = db.StringField()
+    created_at = db.LongField(required=True)
+    is_read = db.BooleanField(default=False)
+    count = db.IntField(default=1)  # number of coalesced events
+
+
+class LegacyAlertRecord(gj.EmbeddedDocument):
     id = db.ObjectIdField(
         required=True, default=lambda: ObjectId())
     push_type = db.StringField(
@@ -184,19 +234,48 @@ class AlertRecord(gj.EmbeddedDocument):
     comment_id = db.ObjectIdField()
     request_id = db.ObjectIdField()
     chat_room_id = db.ObjectIdField()
-    message_id = db.ObjectIdField()  # ChatRoom@Message
+    message_id = db.ObjectIdField()  # ChatMessage
     message = db.StringField()
     created_at = db.LongField(required=True)
     is_read = db.BooleanField()
 
 
 class Alert(gj.Document):
+    """Deprecated: records are stored in AlertRecord collection.
+       Kept only to migrate the embedded records.
+    """
     meta = {
         'queryset_class': fm.BaseQuerySet
     }
     owner = db.ReferenceField(
         User, reverse_delete_rule=db.CASCADE)
     records = db.SortedListField(
-        db.EmbeddedDocumentField(AlertRecord),
+        db.EmbeddedDocumentField(LegacyAlertRecord),
         ordering="created_at", reverse=True
     )
+
+
+class PushJob(gj.Document):
+    """A push waiting in the outbox, claimed until `next_attempt_at`."""
+    meta = {
+        'queryset_class': fm.BaseQuerySet,
+        'indexes': ['next_attempt_at']
+    }
+    data = db.DictField()
+    tokens = db.ListField(db.StringField(), required=True)
+    attempts = db.IntField(default=0)
+    next_attempt_at = db.LongField(required=True)
+    created_at = db.LongField(required=True)
+    last_error = db.StringField()
+
+
+class DeadPushJob(gj.Document):
+    meta = {
+        'queryset_class': fm.BaseQuerySet
+    }
+    data = db.DictField()
+    tokens = db.ListField(db.StringField())
+    attempts = db.IntField()
+    created_at = db.LongField()
+    failed_at = db.LongField(required=True)
+    last_error = db.StringField()
@@ -1,12 +1,19 @@
 import os
 
 from main import app
+from blueprints import alerts_blueprint
 from config import TestConfig
 from shared.instances import mdb, init_firebase
+from shared import chat_archive
+from shared import push_outbox
 
 app.config.from_object(TestConfig)
 mdb.init_app(app)
 init_firebase(TestConfig)
+push_outbox.start()
+chat_archive.start()
+# GET /alerts reads only the records moved out of the legacy alerts.
+alerts_blueprint.start_legacy_alerts_migration()
 
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
@@ -0,0 +1,275 @@
+import atexit
+import gzip
+import json
+import logging
+import os
+import pendulum
+import threading
+import uuid
+
+from bson.objectid import ObjectId
+from firebase_admin import storage as firebase_storage
+from google.api_core.exceptions import PreconditionFailed
+from model.models import ChatRoom, ChatMessage
+
+ARCHIVE_AGE = 180 * 24 * 60 * 60  # seconds, older messages are archived.
+ARCHIVE_PREFIX = "chat_archive"
+BATCH_SIZE = 1000
+ARCHIVE_INTERVAL = 60 * 60  # seconds
+MAX_APPEND_ATTEMPTS = 5
+
+_workers = []
+_stopping = threading.Event()
+
+
+class BucketStorage(object):
+    """Segments in the storage bucket, appended by composing objects."""
+    
+    def append(self, name: str, data: bytes):
+        """Appends unless another run changed the segment in between,
+           which is read again and retried.
+        """
+        bucket = firebase_storage.bucket()
+        for attempt in range(MAX_APPEND_ATTEMPTS):
+            try:
+                return self._append(bucket, name, data)
+            except PreconditionFailed:
+                if attempt + 1 >= MAX_APPEND_ATTEMPTS:
+                    raise
+    
+    def _append(self, bucket, name: str, data: bytes):
+        blob = bucket.get_blob(name)
+        if not blob:
+            bucket.blob(name).upload_from_string(
+                data, content_type="application/gzip", if_generation_match=0)
+            return
+        
+        part = bucket.blob("{0}.{1}".format(name, uuid.uuid4().hex))
+        part.upload_from_string(
+            data, content_type="application/gzip", if_generation_match=0)
+        try:
+            # the preconditions match the sources item to item.
+            blob.compose(
+                [blob, part], if_generation_match=[blob.generation, None])
+        finally:
+            part.delete()
+    
+    def read(self, name: str) -> bytes:
+        blob = firebase_storage.bucket().get_blob(name)
+        return blob.download_as_string() if blob else None
+    
+    def list(self, prefix: str) -> list:
+        return [
+            blob.name for blob in
+            firebase_storage.bucket().list_blobs(prefix=prefix)
+        ]
+
+
+class LocalStorage(object):
+    """Segments in a local directory, stands in for the bucket."""
+    
+    def __init__(self, root: str):
+        self.root = root
+    
+    def append(self, name: str, data: bytes):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "ab") as segment:
+            segment.write(data)
+    
+    def read(self, name: str) -> bytes:
+        path = os.path.join(self.root, name)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as segment:
+            return segment.read()
+    
+    def list(self, prefix: str) -> list:
+        directory = os.path.join(self.root, os.path.dirname(prefix))
+        if not os.path.isdir(directory):
+            return []
+        names = [
+            os.path.join(os.path.dirname(prefix), name)
+            for name in os.listdir(directory)
+        ]
+        return [name for name in names if name.startswith(prefix)]
+
+
+storage = BucketStorage()
+
+
+def get_segment_name(chat_room_id, month: str) -> str:
+    return "{prefix}/{chat_room_id}/{month}.jsonl.gz".format(
+        prefix=ARCHIVE_PREFIX, chat_room_id=chat_room_id, month=month)
+
+
+def get_month(timestamp: int) -> str:
+    return pendulum.from_timestamp(timestamp).format("YYYY-MM")
+
+
+def archive_messages(age=ARCHIVE_AGE, batch_size=BATCH_SIZE) -> int:
+    """Moves the messages older than `age` seconds to a segment per room
+       and month, returns the number of messages archived.
+       A segment is appended before the messages are deleted, so a failed
+       run leaves duplicates which the readers skip, never a gap. The
+       appends are conditional, so concurrent runs never overwrite each
+       other either.
+    """
+    cutoff = pendulum.now().int_timestamp - age
+    archived = 0
+    
+    # a room at a time, its old messages are a range of the room's index.
+    for chat_room_id in ChatRoom.objects.no_cache().scalar("id"):
+        while True:
+            messages = list(ChatMessage.objects(
+                chat_room=chat_room_id, created_at__lt=cutoff).order_by(
+                "created_at", "id").limit(
+                batch_size).no_dereference().as_pymongo())
+            if not messages:
+                break
+            
+            archive_segments(chat_room_id, messages)
+            ChatMessage.objects(
+                id__in=[message["_id"] for message in messages]).delete()
+            archived += len(messages)
+    
+    return archived
+
+
+def archive_segments(chat_room_id, messages: list):
+    """Appends the messages of the room oldest first to their segments."""
+    segments = {}
+    for message in messages:
+        segments.setdefault(get_month(message["created_at"]), []).append(message)
+    
+    for month, records in segments.items():
+        lines = "".join(
+            json.dumps(dictify_archived_message(record)) + "\n"
+            for record in records)
+        # a gzip member per append, the segment reads as a single file.
+        storage.append(
+            get_segment_name(chat_room_id, month),
+            gzip.compress(lines.encode()))
+        ChatRoom.objects(id=chat_room_id).update_one(
+            max__archived_until=records[-1]["created_at"])
+
+
+def dictify_archived_message(record: dict) -> dict:
+    message = dict(
+        id=str(record["_id"]),
+        user_id=str(record.get("user_id")),
+        message=record.get("message"),
+        created_at=record["created_at"])
+    # kept for the bulk posts retried after their messages are archived.
+    if record.get("client_id"):
+        message["client_id"] = record["client_id"]
+    return message
+
+
+def read_segment(name: str) -> list:
+    """Messages of the segment oldest first, without duplicates."""
+    data = storage.read(name)
+    if not data:
+        return []
+    
+    messages = {}
+    for line in gzip.decompress(data).decode().splitlines():
+        if line:
+            message = json.loads(line)
+            messages[message["id"]] = message
+    return sorted(
+        messages.values(), key=lambda m: (m["created_at"], m["id"]))
+
+
+def list_archived_messages(chat_room_id, before=None, after=None,
+                           limit=BATCH_SIZE, newest=True) -> list:
+    """Archived messages of the room between the `before` and `after`
+       message ids, newest first. The `limit` newest of them, or the
+       oldest right after `after` when not `newest`.
+       The cursors are archived ones, None is unbounded.
+    """
+    prefix = "{prefix}/{chat_room_id}/".format(
+        prefix=ARCHIVE_PREFIX, chat_room_id=chat_room_id)
+    months = sorted(
+        name[len(prefix):-len(".jsonl.gz")]
+        for name in storage.list(prefix) if name.endswith(".jsonl.gz"))
+    
+    # an id is made about when its message is, a month of margin.
+    if before and ObjectId.is_valid(before):
+        bound = pendulum.instance(ObjectId(before).generation_time).add(
+            months=1).format("YYYY-MM")
+        months = [month for month in months if month <= bound]
+    if after and ObjectId.is_valid(after):
+        bound = pendulum.instance(ObjectId(after).generation_time).subtract(
+            months=1).format("YYYY-MM")
+        months = [month for month in months if month >= bound]
+    
+    first, last = (before, after) if newest else (after, before)
+    if newest:
+        months.reverse()
+    
+    result, started = [], not first
+    for month in months:
+        messages = read_segment(get_segment_name(chat_room_id, month))
+        if newest:
+            messages.reverse()
+        for message in messages:
+            if not started:
+                started = message["id"] == str(first)
+                continue
+            if last and message["id"] == str(last):
+                return result if newest else result[::-1]
+            message.pop("client_id", None)
+            result.append(message)
+            if len(result) >= limit:
+                return result if newest else result[::-1]
+    
+    return result if newest else result[::-1]
+
+
+def find_archived_messages(chat_room_id, client_ids: list) -> dict:
+    """Archived messages of the room by their client_id, the newest
+       segments are read first.
+    """
+    prefix = "{prefix}/{chat_room_id}/".format(
+        prefix=ARCHIVE_PREFIX, chat_room_id=chat_room_id)
+    names = sorted(
+        (name for name in storage.list(prefix) if name.endswith(".jsonl.gz")),
+        reverse=True)
+    
+    client_ids, found = set(client_ids), {}
+    for name in names:
+        for message in read_segment(name):
+            if message.get("client_id") in client_ids:
+                found[message["client_id"]] = message
+        if len(found) >= len(client_ids):
+            break
+    return found
+
+
+def start(count=1):
+    _stopping.clear()
+    for index in range(count):
+        worker = threading.Thread(
+            target=_work, name="chat-archive-%d" % index, daemon=True)
+        worker.start()
+        _workers.append(worker)
+
+
+def stop(timeout=10):
+    _stopping.set()
+    for worker in _workers:
+        worker.join(timeout=timeout)
+    _workers.clear()
+
+
+def _work():
+    while not _stopping.is_set():
+        try:
+            archive_messages()
+        except Exception as e:
+            logging.exception(e)
+        _stopping.wait(ARCHIVE_INTERVAL)
+
+
+atexit.register(stop)
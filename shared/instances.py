@@ -4,9 +4,12 @@ import os
 from firebase_admin import credentials
 from flask_mongoengine import MongoEngine
 from pathlib import Path
+from shared.pubsub import Broker
 
 mdb = MongoEngine()
 
+broker = Broker()
+
 credential_path = os.path.join(
     Path(os.path.dirname(
         os.path.abspath(__file__))).parent, 'requirements.txt')
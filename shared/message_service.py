@@ -1,14 +1,363 @@
+import atexit
+import firebase_admin
+import itertools
 import logging
+import pendulum
+import queue
+import threading
+import time
+
+from concurrent.futures import Future
+from firebase_admin import exceptions
 from firebase_admin import messaging
+from model.models import User, PushJob
+
+MAX_QUEUE_SIZE = 10000
+WORKER_COUNT = 4
+
+MAX_BATCH_SIZE = 500  # limit of messaging.send_all
+MAX_MULTICAST_TOKENS = 500  # limit of messaging.MulticastMessage
+FLUSH_INTERVAL = 0.005  # seconds
+STATS_INTERVAL = 60  # seconds between the log lines of the stats
+
+MAX_DEAD_TOKENS = 100000
+
+# errors meaning the token will never be valid again.
+DEAD_TOKEN_ERRORS = (
+    messaging.UnregisteredError,
+    messaging.SenderIdMismatchError,
+    exceptions.InvalidArgumentError
+)
+
+_queue = queue.Queue(maxsize=MAX_QUEUE_SIZE)
+_workers = []
+_stats_logger = None
+_stats_stopping = threading.Event()
+_lock = threading.Lock()
+_stats = dict(enqueued=0, sent=0, failed=0, dropped=0, pruned=0)
+_dead_tokens = set()
+_local = threading.local()
+_app_ids = itertools.count()
+_logger = logging.getLogger(__name__)
+
 
+def push(data=None, tokens=None) -> PushJob:
+    """Stores a push to the devices of a user in the outbox,
+       sent later by shared.push_outbox.
+    """
+    jobs = push_many([(data, tokens)])
+    return next(iter(jobs), None)
 
-def push(data=None, token=None):
+
+def push_many(pushes: list) -> list:
+    """Stores (data, tokens) pairs in the outbox with a single insert."""
+    now = pendulum.now().int_timestamp
+    jobs = []
+    for data, tokens in pushes:
+        tokens = get_live_tokens(tokens)
+        if tokens:
+            jobs.append(PushJob(data=data, tokens=tokens,
+                                next_attempt_at=now, created_at=now))
+    if not jobs:
+        return []
+    return PushJob.objects.insert(jobs)
+
+
+def dispatch(data=None, tokens=None) -> Future:
+    """Enqueues a multicast message per MAX_MULTICAST_TOKENS tokens of
+       a user then returns without waiting for FCM.
+       The future is resolved with the messaging.BatchResponse whose
+       responses are in the order of the tokens returned by get_live_tokens,
+       or fails with UnavailableError when the queue is full.
+       None only when there is no live token to push.
+    """
+    tokens = get_live_tokens(tokens)
+    if not tokens:
+        return None
+    
+    start_workers()
+    
+    groups = []
+    for index in range(0, len(tokens), MAX_MULTICAST_TOKENS):
+        group = tokens[index:index + MAX_MULTICAST_TOKENS]
+        groups.append((group, _enqueue(data, group)))
+    
+    if len(groups) == 1:
+        return groups[0][1]
+    return _gather(groups)
+
+
+def _enqueue(data, tokens: list) -> Future:
+    message = messaging.MulticastMessage(
+        data=data, tokens=tokens,
+        apns=messaging.APNSConfig(),
+        android=messaging.AndroidConfig(priority="high"),
+        notification=messaging.Notification())
+    future = Future()
+    
     try:
-        message = messaging.Message(
-            data=data, token=token,
-            apns=messaging.APNSConfig(),
-            android=messaging.AndroidConfig(priority="high"),
-            notification=messaging.Notification())
-        messaging.send(message)
+        _queue.put_nowait((message, future))
+    except queue.Full:
+        _count("dropped", len(tokens))
+        logging.error("Push queue is full, dropped a push to %s" % tokens)
+        future.set_exception(exceptions.UnavailableError("Push queue is full"))
+        return future
+    
+    _count("enqueued", len(tokens))
+    return future
+
+
+def _gather(groups: list) -> Future:
+    """A future of the responses of (tokens, future) groups in order,
+       a group failed as a whole fails each of its tokens.
+    """
+    gathered = Future()
+    pending = [len(groups)]
+    lock = threading.Lock()
+    
+    def resolve(_=None):
+        with lock:
+            pending[0] -= 1
+            if pending[0]:
+                return
+        responses = []
+        for tokens, future in groups:
+            try:
+                responses.extend(future.result().responses)
+            except Exception as e:
+                responses.extend(
+                    messaging.SendResponse(None, e) for _ in tokens)
+        gathered.set_result(messaging.BatchResponse(responses))
+    
+    for _, future in groups:
+        future.add_done_callback(resolve)
+    return gathered
+
+
+def get_live_tokens(tokens) -> list:
+    """Drops the empty, duplicated and dead tokens, keeping the order."""
+    if isinstance(tokens, str):
+        tokens = [tokens]
+    live_tokens = []
+    for token in tokens or []:
+        if token and token not in _dead_tokens and token not in live_tokens:
+            live_tokens.append(token)
+    return live_tokens
+
+
+def start_workers(count=WORKER_COUNT):
+    global _stats_logger
+    with _lock:
+        if not _stats_logger or not _stats_logger.is_alive():
+            _stats_stopping.clear()
+            _stats_logger = threading.Thread(
+                target=_log_stats, name="push-stats", daemon=True)
+            _stats_logger.start()
+        alive = [worker for worker in _workers if worker.is_alive()]
+        for index in range(len(alive), count):
+            worker = threading.Thread(
+                target=_work, name="push-worker-%d" % index, daemon=True)
+            worker.start()
+            alive.append(worker)
+        _workers[:] = alive
+
+
+def drain(timeout=None) -> bool:
+    """Waits until every queued push is sent, False if timed out."""
+    with _queue.all_tasks_done:
+        return _queue.all_tasks_done.wait_for(
+            lambda: not _queue.unfinished_tasks, timeout=timeout)
+
+
+def shutdown(timeout=10):
+    """Drains the queue then stops the workers and the stats log."""
+    drained = drain(timeout=timeout)
+    
+    with _lock:
+        workers = list(_workers)
+        _workers.clear()
+        stats_logger = _stats_logger
+    
+    for _ in workers:
+        _queue.put(None)
+    for worker in workers:
+        worker.join(timeout=timeout)
+    
+    _stats_stopping.set()
+    if stats_logger:
+        stats_logger.join(timeout=timeout)
+    
+    return drained
+
+
+def get_stats() -> dict:
+    with _lock:
+        stats = dict(_stats)
+        stats["workers"] = len(
+            [worker for worker in _workers if worker.is_alive()])
+    stats["queue_depth"] = _queue.qsize()
+    return stats
+
+
+def _log_stats():
+    """Logs the counters every STATS_INTERVAL while they change."""
+    logged = None
+    while not _stats_stopping.wait(STATS_INTERVAL):
+        stats = get_stats()
+        if stats != logged:
+            _logger.info("Push stats: %s" % stats)
+            logged = stats
+
+
+def discard_dead_token(token):
+    """Allows pushes to the token registered again."""
+    with _lock:
+        _dead_tokens.discard(token)
+
+
+def _count(key, value=1):
+    with _lock:
+        _stats[key] += value
+
+
+def _get_worker_app():
+    """send_all shares a httplib2 transport per app which is not thread
+       safe, so each worker sends with an app of its own.
+    """
+    app = getattr(_local, "app", None)
+    if app is None:
+        default_app = firebase_admin.get_app()
+        app = firebase_admin.initialize_app(
+            default_app.credential,
+            dict(projectId=default_app.project_id),
+            name="push-worker-app-%d" % next(_app_ids))
+        _local.app = app
+    return app
+
+
+def _work():
+    try:
+        _dispatch_batches()
+    finally:
+        app = getattr(_local, "app", None)
+        if app is not None:
+            firebase_admin.delete_app(app)
+
+
+def _dispatch_batches():
+    pending = None  # an item left over from the previous batch.
+    while True:
+        item = pending or _queue.get()
+        pending = None
+        if item is None:
+            _queue.task_done()
+            return
+        
+        # collects the pushes queued in the flush interval as a batch
+        # of up to MAX_BATCH_SIZE messages.
+        batch, stopped = [item], False
+        size = len(item[0].tokens)
+        deadline = time.monotonic() + FLUSH_INTERVAL
+        while size < MAX_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = _queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                stopped = True
+                break
+            if size + len(item[0].tokens) > MAX_BATCH_SIZE:
+                pending = item
+                break
+            batch.append(item)
+            size += len(item[0].tokens)
+        
+        try:
+            _send_batch(batch)
+        finally:
+            for _ in range(len(batch) + int(stopped)):
+                _queue.task_done()
+        
+        if stopped:
+            return
+
+
+def _send_batch(batch: list):
+    # a multicast message goes out as a message per token.
+    messages = [
+        messaging.Message(
+            data=multicast.data, token=token,
+            notification=multicast.notification,
+            android=multicast.android,
+            webpush=multicast.webpush,
+            apns=multicast.apns,
+            fcm_options=multicast.fcm_options)
+        for multicast, _ in batch
+        for token in multicast.tokens
+    ]
+    
+    try:
+        response = messaging.send_all(messages, app=_get_worker_app())
+    except Exception as e:
+        _count("failed", len(messages))
+        logging.exception(e)
+        for _, future in batch:
+            future.set_exception(e)
+        return
+    
+    _count("sent", response.success_count)
+    _count("failed", response.failure_count)
+    
+    tokens = [message.token for message in messages]
+    prune_dead_tokens(tokens, response.responses)
+    
+    # the order of responses corresponds to the order of the messages.
+    offset = 0
+    for multicast, future in batch:
+        size = len(multicast.tokens)
+        future.set_result(messaging.BatchResponse(
+            response.responses[offset:offset + size]))
+        offset += size
+
+
+def is_dead_token_error(exception) -> bool:
+    return isinstance(exception, DEAD_TOKEN_ERRORS)
+
+
+def prune_dead_tokens(tokens: list, responses: list) -> list:
+    """Clears the tokens rejected permanently from the users.
+       The order of responses corresponds to the order of the tokens.
+    """
+    dead_tokens = []
+    for token, response in zip(tokens, responses):
+        if response.success:
+            continue
+        if is_dead_token_error(response.exception):
+            dead_tokens.append(token)
+        else:
+            logging.warning("Failed to push to %s: %s" % (
+                token, response.exception))
+    
+    if not dead_tokens:
+        return dead_tokens
+    
+    with _lock:
+        if len(_dead_tokens) > MAX_DEAD_TOKENS:
+            _dead_tokens.clear()
+        _dead_tokens.update(dead_tokens)
+    
+    try:
+        User.objects(r_tokens__in=dead_tokens).update(
+            pull_all__r_tokens=dead_tokens)
+        User.objects(r_token__in=dead_tokens).update(unset__r_token=True)
+        _count("pruned", len(dead_tokens))
     except Exception as e:
         logging.exception(e)
+    
+    return dead_tokens
+
+
+atexit.register(shutdown)
@@ -0,0 +1,71 @@
+import logging
+import queue
+import threading
+
+
+class Subscription(object):
+    """Queue of the items published to a channel."""
+    
+    def __init__(self, broker, channel, maxsize=100):
+        self.broker = broker
+        self.channel = channel
+        self.queue = queue.Queue(maxsize=maxsize)
+    
+    def get(self, timeout=None):
+        """Waits for the next item, returns None when timed out."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+    
+    def close(self):
+        self.broker.unsubscribe(self)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Broker(object):
+    """In-process pub/sub, wakes only the subscribers of this process."""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+    
+    def subscribe(self, channel, maxsize=100) -> Subscription:
+        subscription = Subscription(self, channel, maxsize=maxsize)
+        with self._lock:
+            self._subscriptions.setdefault(
+                channel, set()).add(subscription)
+        return subscription
+    
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(
+                subscription.channel, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self._subscriptions.pop(subscription.channel, None)
+    
+    def has_subscribers(self, channel) -> bool:
+        with self._lock:
+            return bool(self._subscriptions.get(channel))
+    
+    def publish(self, channel, item) -> int:
+        """Publishes the item, returns the number of subscribers received."""
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(channel, []))
+        
+        received = 0
+        for subscription in subscriptions:
+            try:
+                subscription.queue.put_nowait(item)
+                received += 1
+            except queue.Full:
+                # a slow subscriber drops items rather than blocking writers.
+                logging.warning(
+                    "Dropped an item for a full subscription: %s" % channel)
+        return received
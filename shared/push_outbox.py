@@ -0,0 +1,154 @@
+import atexit
+import logging
+import pendulum
+import random
+import threading
+
+from model.models import PushJob, DeadPushJob
+from shared import message_service
+
+MAX_ATTEMPTS = 5
+CLAIM_LEASE = 60  # seconds, a job is retried when its worker dies.
+BACKOFF_BASE = 2  # seconds
+MAX_BACKOFF = 60 * 60  # seconds
+POLL_INTERVAL = 1  # seconds
+RESULT_TIMEOUT = 30  # seconds
+
+_workers = []
+_stopping = threading.Event()
+
+
+def get_backoff(attempts: int) -> int:
+    """Exponential backoff with jitter, in seconds."""
+    delay = min(MAX_BACKOFF, BACKOFF_BASE * 2 ** max(attempts - 1, 0))
+    return int(delay / 2 + random.uniform(0, delay / 2))
+
+
+def claim_jobs(limit=message_service.MAX_BATCH_SIZE) -> list:
+    """Claims the due jobs one by one, hidden from others until the lease."""
+    jobs = []
+    while len(jobs) < limit:
+        now = pendulum.now().int_timestamp
+        job = PushJob.objects(next_attempt_at__lte=now).order_by(
+            "next_attempt_at").modify(
+            new=True, inc__attempts=1,
+            set__next_attempt_at=now + CLAIM_LEASE)
+        if not job:
+            break
+        jobs.append(job)
+    return jobs
+
+
+def process_outbox(dispatch=None) -> int:
+    """Sends the due jobs once, returns the number of jobs claimed.
+       `dispatch` takes (data, tokens) and returns a future of
+       BatchResponse in the order of the tokens, None when nothing to send.
+    """
+    dispatch = dispatch or message_service.dispatch
+    jobs = claim_jobs()
+    if not jobs:
+        return 0
+    
+    # the responses are zipped with the tokens dispatched.
+    tokens = [message_service.get_live_tokens(job.tokens) for job in jobs]
+    futures = [
+        dispatch(job.data, job_tokens)
+        for job, job_tokens in zip(jobs, tokens)
+    ]
+    
+    done_ids = []
+    for job, job_tokens, future in zip(jobs, tokens, futures):
+        try:
+            # no future only when every token has been found dead,
+            # a full dispatcher fails the future to retry the job.
+            response = future.result(timeout=RESULT_TIMEOUT) if future else None
+            failed_tokens, exception = get_failed_tokens(job_tokens, response)
+        except Exception as e:
+            failed_tokens, exception = job_tokens, e
+        
+        if not failed_tokens:
+            done_ids.append(job.id)
+        elif job.attempts >= MAX_ATTEMPTS:
+            bury_job(job, failed_tokens, exception)
+        else:
+            retry_job(job, failed_tokens, exception)
+    
+    if done_ids:
+        PushJob.objects(id__in=done_ids).delete()
+    
+    return len(jobs)
+
+
+def get_failed_tokens(tokens: list, response) -> tuple:
+    """Returns the tokens to retry and the last of their errors,
+       the dead tokens are never retried.
+    """
+    failed_tokens, exception = [], None
+    for token, result in zip(tokens, response.responses if response else []):
+        if result.success or \
+                message_service.is_dead_token_error(result.exception):
+            continue
+        failed_tokens.append(token)
+        exception = result.exception
+    return failed_tokens, exception
+
+
+def retry_later(data, tokens: list, exception) -> PushJob:
+    """Stores a push failed on its first attempt, sent by the outbox
+       after the backoff.
+    """
+    now = pendulum.now().int_timestamp
+    return PushJob(
+        data=data, tokens=tokens, attempts=1,
+        next_attempt_at=now + get_backoff(1), created_at=now,
+        last_error=str(exception)).save()
+
+
+def retry_job(job: PushJob, tokens: list, exception):
+    job.update(
+        set__tokens=tokens,
+        set__next_attempt_at=pendulum.now().int_timestamp +
+        get_backoff(job.attempts),
+        set__last_error=str(exception))
+
+
+def bury_job(job: PushJob, tokens: list, exception):
+    """Moves the job failed too many times to the dead letters."""
+    DeadPushJob(
+        data=job.data, tokens=tokens, attempts=job.attempts,
+        created_at=job.created_at,
+        failed_at=pendulum.now().int_timestamp,
+        last_error=str(exception)).save()
+    job.delete()
+    logging.error("Push job %s is moved to the dead letters: %s" % (
+        job.id, exception))
+
+
+def start(count=1):
+    _stopping.clear()
+    for index in range(count):
+        worker = threading.Thread(
+            target=_work, name="push-outbox-%d" % index, daemon=True)
+        worker.start()
+        _workers.append(worker)
+
+
+def stop(timeout=10):
+    _stopping.set()
+    for worker in _workers:
+        worker.join(timeout=timeout)
+    _workers.clear()
+
+
+def _work():
+    while not _stopping.is_set():
+        try:
+            processed = process_outbox()
+        except Exception as e:
+            processed = 0
+            logging.exception(e)
+        if not processed:
+            _stopping.wait(POLL_INTERVAL)
+
+
+atexit.register(stop)
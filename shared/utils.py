@@ -1,3 +1,35 @@
+from bson.objectid import ObjectId
+from flask import abort
+from flask import request
+
+
 def get_user_first_image(user):
     user_image = next(iter(user.user_images or []), None)
     image_url = user_image.url if user_image else ""
+
+
+def get_registration_tokens(user) -> list:
+    """Returns the tokens of every device of the user, newest first."""
+    tokens = list(user.r_tokens or [])
+    if user.r_token and user.r_token not in tokens:
+        tokens.insert(0, user.r_token)
+    return tokens
+
+
+def get_int_arg(name: str, default=None):
+    """An integer query parameter, 400 if it is not one."""
+    value = request.args.get(name, None)
+    if not value:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
+
+
+def get_id_arg(name: str):
+    """An ObjectId query parameter as given, 400 if it is not one."""
+    value = request.args.get(name, None)
+    if value and not ObjectId.is_valid(value):
+        abort(400)
+    return value or None